@@ -95,7 +95,9 @@ void usage ()
 }
 
 
-using value_type = float;
+// Values are read and results are written in double precision, such that partial results stored
+//   with -datatype float64 (e.g. sums over subsets of a large number of images) are not truncated
+using value_type = double;
 
 
 class Mean { NOMEMALIGN
@@ -388,7 +390,7 @@ void run ()
     header_out.size(axis) = 1;
     squeeze_dim (header_out);
 
-    auto image_out = Header::create (output_path, header_out).get_image<float>();
+    auto image_out = Header::create (output_path, header_out).get_image<value_type>();
 
     auto loop = ThreadedLoop (std::string("computing ") + operations[op] + " along axis " + str(axis) + "...", image_out);
 
@@ -15,7 +15,7 @@
 
 import os.path, shutil
 from mrtrix3 import MRtrixError
-from mrtrix3 import app, path, run
+from mrtrix3 import app, image, path, run
 
 
 
@@ -65,18 +65,12 @@ def execute(): #pylint: disable=unused-variable
 
   # Crop to reduce file size
   if app.ARGS.nocrop:
-    image = 'indices.mif'
+    indices_image = 'indices.mif'
   else:
-    image = 'indices_cropped.mif'
-    run.command('mrthreshold indices.mif - -abs 0.5 | mrgrid indices.mif crop ' + image + ' -mask -')
+    indices_image = 'indices_cropped.mif'
+    run.command('mrthreshold indices.mif - -abs 0.5 | mrgrid indices.mif crop ' + indices_image + ' -mask -')
 
   # Convert into the 5TT format for ACT
-  run.command('mrcalc ' + image + ' 1 -eq cgm.mif')
-  run.command('mrcalc ' + image + ' 2 -eq sgm.mif')
-  run.command('mrcalc ' + image + ' 3 -eq  wm.mif')
-  run.command('mrcalc ' + image + ' 4 -eq csf.mif')
-  run.command('mrcalc ' + image + ' 5 -eq path.mif')
-
-  run.command('mrcat cgm.mif sgm.mif wm.mif csf.mif path.mif - -axis 3 | mrconvert - result.mif -datatype float32')
+  image.labels_to_volumes(indices_image, 'result.mif', [ [ 1 ], [ 2 ], [ 3 ], [ 4 ], [ 5 ] ])
 
   run.command('mrconvert result.mif ' + path.from_user(app.ARGS.output), mrconvert_keyval=path.from_user(app.ARGS.input, False), force=app.FORCE_OVERWRITE)
@@ -45,20 +45,9 @@ def get_inputs(): #pylint: disable=unused-variable
 
 
 def execute(): #pylint: disable=unused-variable
-  # Generate the images related to each tissue
-  run.command('mrconvert input.mif -coord 3 1 CSF.mif')
-  run.command('mrconvert input.mif -coord 3 2 cGM.mif')
-  run.command('mrconvert input.mif -coord 3 3 cWM.mif')
-  run.command('mrconvert input.mif -coord 3 4 sGM.mif')
-
-  # Combine WM and subcortical WM into a unique WM image
-  run.command('mrconvert input.mif - -coord 3 3,5 | mrmath - sum WM.mif -axis 3')
-
-  # Create an empty lesion image
-  run.command('mrcalc WM.mif 0 -mul lsn.mif')
-
-  # Convert into the 5tt format
-  run.command('mrcat cGM.mif sGM.mif WM.mif CSF.mif lsn.mif 5tt.mif -axis 3')
+  # Convert into the 5tt format:
+  #   cGM, sGM, WM (combining WM and subcortical WM), CSF, and an empty lesion volume
+  image.combine_volumes('input.mif', '5tt.mif', [ [ 2 ], [ 4 ], [ 3, 5 ], [ 1 ], [ ] ])
 
   if app.ARGS.nocrop:
     run.function(os.rename, '5tt.mif', 'result.mif')
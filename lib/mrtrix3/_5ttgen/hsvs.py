@@ -18,10 +18,10 @@
 
 
 
-import glob, os, re
+import array, functools, glob, hashlib, json, os, re, shutil
 from distutils.spawn import find_executable
-from mrtrix3 import MRtrixError
-from mrtrix3 import app, fsl, image, path, run
+from mrtrix3 import MRtrixError, __version__
+from mrtrix3 import app, fsl, image, path, run, surface
 
 
 
@@ -44,6 +44,8 @@ def usage(base_parser, subparsers): #pylint: disable=unused-variable
   parser.add_argument('-hippocampi', choices=HIPPOCAMPI_CHOICES, help='Select method to be used for hippocampi (& amygdalae) segmentation; options are: ' + ','.join(HIPPOCAMPI_CHOICES))
   parser.add_argument('-thalami', choices=THALAMI_CHOICES, help='Select method to be used for thalamic segmentation; options are: ' + ','.join(THALAMI_CHOICES))
   parser.add_argument('-white_stem', action='store_true', help='Classify the brainstem as white matter')
+  parser.add_argument('-cache', metavar='directory', help='Store surface meshes that depend only on the contents of the FreeSurfer subject directory in the nominated directory, and re-use those already present there; this avoids re-generating these meshes when the algorithm is re-run on the same subject, e.g. with a different template image or choice of segmentation methods')
+  parser.add_argument('-mesh_bbox', action='store_true', help='Map the surface of each non-cortical structure to partial volume fractions only within the bounding box of that surface, rather than across the whole template image; this reduces computation time and the size of intermediate files, particularly for high-resolution template images')
   parser.add_citation('Smith, R.; Skoch, A.; Bajada, C.; Caspers, S.; Connelly, A. Hybrid Surface-Volume Segmentation for improved Anatomically-Constrained Tractography. In Proc OHBM 2020')
   parser.add_citation('Fischl, B. Freesurfer. NeuroImage, 2012, 62(2), 774-781', is_external=True)
   parser.add_citation('Iglesias, J.E.; Augustinack, J.C.; Nguyen, K.; Player, C.M.; Player, A.; Wright, M.; Roy, N.; Frosch, M.P.; Mc Kee, A.C.; Wald, L.L.; Fischl, B.; and Van Leemput, K. A computational atlas of the hippocampal formation using ex vivo, ultra-high resolution MRI: Application to adaptive segmentation of in vivo MRI. NeuroImage, 2015, 115, 117-137', condition='If FreeSurfer hippocampal subfields module is utilised', is_external=True)
@@ -139,6 +141,141 @@ def check_dir(dirpath):
 
 
 
+# The processing of each individual structure is expressed as a sequence of commands,
+#   each accompanied by the list of intermediate files that can be deleted once that
+#   command has completed; since the sequences for different structures are independent
+#   of one another, and all file names are determined in advance, these can be executed
+#   concurrently (see run.parallel())
+def run_sequence(sequence):
+  for cmd, intermediates in sequence:
+    if callable(cmd):
+      cmd()
+    else:
+      run.command(cmd)
+    if intermediates:
+      app.cleanup(intermediates)
+
+def run_sequences(sequences, progress):
+  run.parallel([ functools.partial(run_sequence, sequence) for sequence in sequences ], progress=progress)
+
+# Smooth the surface mesh produced by the provided command, and map it to partial volume
+#   fractions on the template image (see mesh2voxel() regarding 'crop')
+def smooth_mesh_sequence(init_command, init_mesh_path, smooth_mesh_path, template_image, output_image, smooth_options='', intermediates=None, crop=True):
+  return [ ( init_command, intermediates if intermediates else [ ] ),
+           ( 'meshfilter ' + init_mesh_path + ' smooth ' + smooth_mesh_path + smooth_options, [ init_mesh_path ] ),
+           ( functools.partial(mesh2voxel, smooth_mesh_path, template_image, output_image, crop), [ smooth_mesh_path ] ) ]
+
+
+
+# Surface meshes that depend only on the contents of the FreeSurfer subject directory can be stored
+#   in a persistent cache directory (-cache option); each is keyed by the commands used to generate it,
+#   the size & modification time of the files on which it depends, and the versions of the MRtrix3
+#   executables invoked, such that any change to these results in the mesh being re-generated
+# 'sequence' must end with the command that maps 'mesh_path' to the template image; if a cached
+#   version of the mesh exists, all preceding commands are replaced by retrieval from the cache
+def cached_mesh_sequence(sequence, mesh_path, inputs):
+  if not app.ARGS.cache:
+    return sequence
+  commands = [ cmd for cmd, intermediates in sequence[:-1] ]
+  key = { 'mesh': mesh_path,
+          'commands': commands,
+          'inputs': [ [ filepath ] + file_fingerprint(filepath) for filepath in inputs ],
+          'executables': [ [ name ] + file_fingerprint(executable_path(name)) for name in sorted(set(
+            segment.split()[0] for cmd in commands for segment in cmd.split('|') if segment.strip())) ],
+          'version': __version__ }
+  digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+  basename, extension = os.path.splitext(mesh_path)
+  cache_path = os.path.join(path.from_user(app.ARGS.cache, False), basename + '.' + digest + extension)
+  if os.path.isfile(cache_path):
+    return [ ( functools.partial(run.function, shutil.copyfile, cache_path, mesh_path), [ ] ), sequence[-1] ]
+  return sequence[:-1] + [ ( functools.partial(run.function, store_cached_mesh, mesh_path, cache_path), [ ] ), sequence[-1] ]
+
+def is_cached(sequence):
+  return len(sequence) == 2 and isinstance(sequence[0][0], functools.partial) and sequence[0][0].args[0] is shutil.copyfile
+
+def file_fingerprint(filepath):
+  try:
+    return [ os.path.getsize(filepath), os.path.getmtime(filepath) ]
+  except (OSError, TypeError):
+    return [ None, None ]
+
+def executable_path(name):
+  try:
+    return run.version_match(name)
+  except MRtrixError:
+    return None
+
+# Any previously cached versions of the same mesh are removed; writing to a temporary file first
+#   ensures that an incomplete mesh file is never present in the cache
+def store_cached_mesh(mesh_path, cache_path):
+  cache_dir = os.path.dirname(cache_path)
+  basename, extension = os.path.splitext(mesh_path)
+  stale_regex = re.compile('^' + re.escape(basename) + r'\.[0-9a-f]{16}' + re.escape(extension) + '$')
+  for filename in os.listdir(cache_dir):
+    if stale_regex.match(filename):
+      os.remove(os.path.join(cache_dir, filename))
+  temp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+  shutil.copyfile(mesh_path, temp_path)
+  shutil.move(temp_path, cache_path)
+
+
+
+# Map a surface mesh to partial volume fractions on the template image
+# If the -mesh_bbox option is specified and 'crop' is set, the template image is first cropped
+#   to the bounding box of the mesh, such that the output image is a sub-volume of the template
+#   image; these sub-volumes are inserted back into the template voxel grid by sum_tissue_images(),
+#   and so this must only be used for images that are not utilised in any other way
+def mesh2voxel(mesh_path, template_image, output_image, crop=True):
+  bounds = surface.voxel_bounds(mesh_path, template_image) if crop and app.ARGS.mesh_bbox and os.path.isfile(mesh_path) else None
+  if not bounds:
+    run.command('mesh2voxel ' + mesh_path + ' ' + template_image + ' ' + output_image)
+    return
+  cropped_template_image = os.path.splitext(output_image)[0] + '_template.mif'
+  run.command('mrgrid ' + template_image + ' crop ' + cropped_template_image + ' '
+              + ' '.join('-axis ' + str(axis) + ' ' + str(first) + ':' + str(last) for axis, (first, last) in enumerate(bounds)))
+  run.command('mesh2voxel ' + mesh_path + ' ' + cropped_template_image + ' ' + output_image)
+  app.cleanup(cropped_template_image)
+
+
+
+# Sum the partial volume fraction images of all structures attributed to one tissue, clamping
+#   the result to a maximum of 1.0, as per "mrmath <images> sum - | mrcalc - 1.0 -min <output>"
+# Where images are sub-volumes of the template image (see mesh2voxel()), these are added to the
+#   sum of all full-sized images in memory, rather than first being padded to the full FoV
+def sum_tissue_images(images, template_image, output_image):
+  template = image.Header(template_image)
+  size = template.size()[:3]
+  headers = [ image.Header(filepath) for filepath in images ]
+  full_images = [ filepath for filepath, header in zip(images, headers) if header.size()[:3] == size ]
+  if len(full_images) == len(images):
+    run.command('mrmath ' + ' '.join(images) + ' sum - | mrcalc - 1.0 -min ' + output_image)
+    return
+  sum_image = os.path.splitext(output_image)[0] + '_sum.mif'
+  if len(full_images) > 1:
+    run.command('mrmath ' + ' '.join(full_images) + ' sum ' + sum_image)
+    total = array.array('d', image.load_voxels(sum_image, as_array=True))
+  elif full_images:
+    total = array.array('d', image.load_voxels(full_images[0], as_array=True))
+  else:
+    total = array.array('d', [ 0.0 ]) * (size[0]*size[1]*size[2])
+  for filepath, header in zip(images, headers):
+    if filepath in full_images:
+      continue
+    values = image.load_voxels(filepath, as_array=True)
+    offset = image.voxel_offset(header, template)
+    width, height, depth = header.size()[:3]
+    position = 0
+    for z in range(offset[2], offset[2]+depth):
+      for y in range(offset[1], offset[1]+height):
+        start = offset[0] + size[0] * (y + size[1] * z)
+        total[start:start+width] = array.array('d', [ a + b for a, b in zip(total[start:start+width], values[position:position+width]) ])
+        position += width
+  image.save_voxels(sum_image, total, template)
+  run.command('mrcalc ' + sum_image + ' 1.0 -min ' + output_image)
+  app.cleanup(sum_image)
+
+
+
 
 def check_output_paths(): #pylint: disable=unused-variable
   app.check_output_path(app.ARGS.output)
@@ -165,12 +302,16 @@ def execute(): #pylint: disable=unused-variable
   check_dir(mri_dir)
   #aparc_image = os.path.join(mri_dir, 'aparc+aseg.mgz')
   aparc_image = 'aparc.mif'
+  # Source of aparc_image, on which any cached meshes derived from the latter depend
+  aparc_source = os.path.join(mri_dir, 'aparc+aseg.mgz')
   mask_image = os.path.join(mri_dir, 'brainmask.mgz')
   reg_file = os.path.join(mri_dir, 'transforms', 'talairach.xfm')
   check_file(aparc_image)
   check_file(mask_image)
   check_file(reg_file)
   template_image = 'template.mif' if app.ARGS.template else aparc_image
+  if app.ARGS.cache:
+    path.make_dir(path.from_user(app.ARGS.cache, False))
 
   have_first = False
   have_fast = False
@@ -341,17 +482,17 @@ def execute(): #pylint: disable=unused-variable
                     [] ]
 
   # Get the main cerebrum segments; these are already smooth
-  progress = app.ProgressBar('Mapping FreeSurfer cortical reconstruction to partial volume images', 8)
+  sequences = [ ]
   for hemi in [ 'lh', 'rh' ]:
     for basename in [ hemi+'.white', hemi+'.pial' ]:
       filepath = os.path.join(surf_dir, basename)
       check_file(filepath)
       transformed_path = basename + '_realspace.obj'
-      run.command('meshconvert ' + filepath + ' ' + transformed_path + ' -binary -transform fs2real ' + aparc_image)
-      progress.increment()
-      run.command('mesh2voxel ' + transformed_path + ' ' + template_image + ' ' + basename + '.mif')
-      app.cleanup(transformed_path)
-      progress.increment()
+      sequences.append(cached_mesh_sequence([ ( 'meshconvert ' + filepath + ' ' + transformed_path + ' -binary -transform fs2real ' + aparc_image, [ ] ),
+                                              ( 'mesh2voxel ' + transformed_path + ' ' + template_image + ' ' + basename + '.mif', [ transformed_path ] ) ],
+                                            transformed_path, [ filepath, aparc_source ]))
+  progress = app.ProgressBar('Mapping FreeSurfer cortical reconstruction to partial volume images', len(sequences))
+  run_sequences(sequences, progress)
   progress.done()
 
 
@@ -368,144 +509,130 @@ def execute(): #pylint: disable=unused-variable
     from_aseg.extend(THAL_ASEG)
   if not have_first:
     from_aseg.extend(OTHER_SGM_ASEG)
-  progress = app.ProgressBar('Smoothing non-cortical structures segmented by FreeSurfer', len(from_aseg) + 2)
+  sequences = [ ]
   for (index, tissue, name) in from_aseg:
     init_mesh_path = name + '_init.vtk'
     smoothed_mesh_path = name + '.vtk'
-    run.command('mrcalc ' + aparc_image + ' ' + str(index) + ' -eq - | voxel2mesh - -threshold 0.5 ' + init_mesh_path)
-    run.command('meshfilter ' + init_mesh_path + ' smooth ' + smoothed_mesh_path)
-    app.cleanup(init_mesh_path)
-    run.command('mesh2voxel ' + smoothed_mesh_path + ' ' + template_image + ' ' + name + '.mif')
-    app.cleanup(smoothed_mesh_path)
+    sequences.append(cached_mesh_sequence(smooth_mesh_sequence('mrcalc ' + aparc_image + ' ' + str(index) + ' -eq - | voxel2mesh - -threshold 0.5 ' + init_mesh_path,
+                                                               init_mesh_path, smoothed_mesh_path, template_image, name + '.mif'),
+                                          smoothed_mesh_path, [ aparc_source ]))
     tissue_images[tissue-1].append(name + '.mif')
-    progress.increment()
   # Lateral ventricles are separate as we want to combine with choroid plexus prior to mesh conversion
   for hemi_index, hemi_name in enumerate(['Left', 'Right']):
     name = hemi_name + '_LatVent_ChorPlex'
     init_mesh_path = name + '_init.vtk'
     smoothed_mesh_path = name + '.vtk'
-    run.command('mrcalc ' + ' '.join(aparc_image + ' ' + str(index) + ' -eq' for index, tissue, name in VENTRICLE_CP_ASEG[hemi_index]) + ' -add - | '
-                + 'voxel2mesh - -threshold 0.5 ' + init_mesh_path)
-    run.command('meshfilter ' + init_mesh_path + ' smooth ' + smoothed_mesh_path)
-    app.cleanup(init_mesh_path)
-    run.command('mesh2voxel ' + smoothed_mesh_path + ' ' + template_image + ' ' + name + '.mif')
-    app.cleanup(smoothed_mesh_path)
+    sequences.append(cached_mesh_sequence(smooth_mesh_sequence('mrcalc ' + ' '.join(aparc_image + ' ' + str(index) + ' -eq' for index, tissue, name in VENTRICLE_CP_ASEG[hemi_index]) + ' -add - | '
+                                                               + 'voxel2mesh - -threshold 0.5 ' + init_mesh_path,
+                                                               init_mesh_path, smoothed_mesh_path, template_image, name + '.mif'),
+                                          smoothed_mesh_path, [ aparc_source ]))
     tissue_images[3].append(name + '.mif')
-    progress.increment()
+  progress = app.ProgressBar('Smoothing non-cortical structures segmented by FreeSurfer', len(sequences))
+  run_sequences(sequences, progress)
   progress.done()
 
 
 
   # Combine corpus callosum segments before smoothing
-  progress = app.ProgressBar('Combining and smoothing corpus callosum segmentation', len(CORPUS_CALLOSUM_ASEG) + 3)
-  for (index, name) in CORPUS_CALLOSUM_ASEG:
-    run.command('mrcalc ' + aparc_image + ' ' + str(index) + ' -eq ' + name + '.mif -datatype bit')
-    progress.increment()
+  cc_segment_images = [ name + '.mif' for (index, name) in CORPUS_CALLOSUM_ASEG ]
   cc_init_mesh_path = 'combined_corpus_callosum_init.vtk'
   cc_smoothed_mesh_path = 'combined_corpus_callosum.vtk'
-  run.command('mrmath ' + ' '.join([ name + '.mif' for (index, name) in CORPUS_CALLOSUM_ASEG ]) + ' sum - | voxel2mesh - -threshold 0.5 ' + cc_init_mesh_path)
-  for name in [ n for _, n in CORPUS_CALLOSUM_ASEG ]:
-    app.cleanup(name + '.mif')
-  progress.increment()
-  run.command('meshfilter ' + cc_init_mesh_path + ' smooth ' + cc_smoothed_mesh_path)
-  app.cleanup(cc_init_mesh_path)
-  progress.increment()
-  run.command('mesh2voxel ' + cc_smoothed_mesh_path + ' ' + template_image + ' combined_corpus_callosum.mif')
-  app.cleanup(cc_smoothed_mesh_path)
-  progress.done()
+  cc_sequence = [ ( 'mrcalc ' + aparc_image + ' ' + str(index) + ' -eq ' + name + '.mif -datatype bit', [ ] ) for (index, name) in CORPUS_CALLOSUM_ASEG ]
+  cc_sequence.extend(smooth_mesh_sequence('mrmath ' + ' '.join(cc_segment_images) + ' sum - | voxel2mesh - -threshold 0.5 ' + cc_init_mesh_path,
+                                          cc_init_mesh_path, cc_smoothed_mesh_path, template_image, 'combined_corpus_callosum.mif',
+                                          intermediates=cc_segment_images))
   tissue_images[2].append('combined_corpus_callosum.mif')
 
-
-
   # Deal with brain stem, including determining those voxels that should
   #   be erased from the 5TT image in order for streamlines traversing down
   #   the spinal column to be terminated & accepted
   bs_fullmask_path = 'brain_stem_init.mif'
   bs_cropmask_path = ''
-  progress = app.ProgressBar('Segmenting and cropping brain stem', 5)
-  run.command('mrcalc ' + aparc_image + ' ' + str(BRAIN_STEM_ASEG[0][0]) + ' -eq '
-              + ' -add '.join([ aparc_image + ' ' + str(index) + ' -eq' for index, name in BRAIN_STEM_ASEG[1:] ]) + ' -add '
-              + bs_fullmask_path + ' -datatype bit')
-  progress.increment()
   bs_init_mesh_path = 'brain_stem_init.vtk'
-  run.command('voxel2mesh ' + bs_fullmask_path + ' ' + bs_init_mesh_path)
-  progress.increment()
   bs_smoothed_mesh_path = 'brain_stem.vtk'
-  run.command('meshfilter ' + bs_init_mesh_path + ' smooth ' + bs_smoothed_mesh_path)
-  app.cleanup(bs_init_mesh_path)
-  progress.increment()
-  run.command('mesh2voxel ' + bs_smoothed_mesh_path + ' ' + template_image + ' brain_stem.mif')
-  app.cleanup(bs_smoothed_mesh_path)
-  progress.increment()
+  bs_sequence = [ ( 'mrcalc ' + aparc_image + ' ' + str(BRAIN_STEM_ASEG[0][0]) + ' -eq '
+                    + ' -add '.join([ aparc_image + ' ' + str(index) + ' -eq' for index, name in BRAIN_STEM_ASEG[1:] ]) + ' -add '
+                    + bs_fullmask_path + ' -datatype bit', [ ] ) ]
+  bs_sequence.extend(smooth_mesh_sequence('voxel2mesh ' + bs_fullmask_path + ' ' + bs_init_mesh_path,
+                                          bs_init_mesh_path, bs_smoothed_mesh_path, template_image, 'brain_stem.mif',
+                                          intermediates=[ bs_fullmask_path ], crop=False))
+
+  progress = app.ProgressBar('Segmenting and smoothing corpus callosum and brain stem', 2)
+  run_sequences([ cached_mesh_sequence(cc_sequence, cc_smoothed_mesh_path, [ aparc_source ]),
+                  cached_mesh_sequence(bs_sequence, bs_smoothed_mesh_path, [ aparc_source ]) ], progress)
+  progress.done()
   fourthventricle_zmin = min([ int(line.split()[2]) for line in run.command('maskdump 4th-Ventricle.mif')[0].splitlines() ])
+  if app.ARGS.mesh_bbox:
+    fourthventricle_zmin += image.voxel_offset('4th-Ventricle.mif', template_image)[2]
   if fourthventricle_zmin:
     bs_cropmask_path = 'brain_stem_crop.mif'
     run.command('mredit brain_stem.mif - ' + ' '.join([ '-plane 2 ' + str(index) + ' 0' for index in range(0, fourthventricle_zmin) ]) + ' | '
                 'mrcalc brain_stem.mif - -sub 1e-6 -gt ' + bs_cropmask_path + ' -datatype bit')
-  app.cleanup(bs_fullmask_path)
-  progress.done()
 
 
   if hippocampi_method == 'subfields':
-    progress = app.ProgressBar('Using detected FreeSurfer hippocampal subfields module output',
-                               64 if hipp_subfield_has_amyg else 32)
-
     subfields = [ ( hipp_lut_file, 'hipp' ) ]
     if hipp_subfield_has_amyg:
       subfields.append(( amyg_lut_file, 'amyg' ))
 
+    # Extract individual components from each image and assign to different tissues
+    label_sequences = [ ]
+    sequences = [ ]
+    subfields_all_tissues_images = [ ]
     for subfields_lut_file, structure_name in subfields:
       for hemi, filename in zip([ 'Left', 'Right'], [ prefix + hipp_subfield_image_suffix for prefix in [ 'l', 'r' ] ]):
-        # Extract individual components from image and assign to different tissues
         subfields_all_tissues_image = hemi + '_' + structure_name + '_subfields.mif'
-        run.command('labelconvert ' + os.path.join(mri_dir, filename) + ' ' + freesurfer_lut_file + ' ' + subfields_lut_file + ' ' + subfields_all_tissues_image)
-        progress.increment()
+        subfields_all_tissues_images.append(subfields_all_tissues_image)
+        subfields_inputs = [ os.path.join(mri_dir, filename), freesurfer_lut_file, subfields_lut_file, executable_path('labelconvert') ]
+        structure_sequences = [ ]
         for tissue in range(0, 5):
           init_mesh_path = hemi + '_' + structure_name + '_subfield_' + str(tissue) + '_init.vtk'
           smooth_mesh_path = hemi + '_' + structure_name + '_subfield_' + str(tissue) + '.vtk'
           subfield_tissue_image = hemi + '_' + structure_name + '_subfield_' + str(tissue) + '.mif'
-          run.command('mrcalc ' + subfields_all_tissues_image + ' ' + str(tissue+1) + ' -eq - | ' + \
-                      'voxel2mesh - ' + init_mesh_path)
-          progress.increment()
           # Since the hippocampal subfields segmentation can include some fine structures, reduce the extent of smoothing
-          run.command('meshfilter ' + init_mesh_path + ' smooth ' + smooth_mesh_path + ' -smooth_spatial 2 -smooth_influence 2')
-          app.cleanup(init_mesh_path)
-          progress.increment()
-          run.command('mesh2voxel ' + smooth_mesh_path + ' ' + template_image + ' ' + subfield_tissue_image)
-          app.cleanup(smooth_mesh_path)
-          progress.increment()
+          structure_sequences.append(cached_mesh_sequence(smooth_mesh_sequence('mrcalc ' + subfields_all_tissues_image + ' ' + str(tissue+1) + ' -eq - | ' + \
+                                                                               'voxel2mesh - ' + init_mesh_path,
+                                                                               init_mesh_path, smooth_mesh_path, template_image, subfield_tissue_image,
+                                                                               smooth_options=' -smooth_spatial 2 -smooth_influence 2'),
+                                                          smooth_mesh_path, subfields_inputs))
           tissue_images[tissue].append(subfield_tissue_image)
-        app.cleanup(subfields_all_tissues_image)
+        # Label image only needs to be generated if any of the corresponding meshes is not already cached
+        if any(not is_cached(sequence) for sequence in structure_sequences):
+          label_sequences.append([ ( 'labelconvert ' + os.path.join(mri_dir, filename) + ' ' + freesurfer_lut_file + ' ' + subfields_lut_file + ' ' + subfields_all_tissues_image, [ ] ) ])
+        sequences.extend(structure_sequences)
+    # Tissue components can only be processed once all label images have been generated
+    progress = app.ProgressBar('Using detected FreeSurfer hippocampal subfields module output', len(label_sequences) + len(sequences))
+    run_sequences(label_sequences, progress)
+    run_sequences(sequences, progress)
+    app.cleanup(subfields_all_tissues_images)
     progress.done()
 
 
   if thalami_method == 'nuclei':
-    progress = app.ProgressBar('Using detected FreeSurfer thalamic nuclei module output', 6)
+    sequences = [ ]
     for hemi in ['Left', 'Right']:
       thal_mask_path = hemi + '_Thalamus_mask.mif'
       init_mesh_path = hemi + '_Thalamus_init.vtk'
       smooth_mesh_path = hemi + '_Thalamus.vtk'
       thalamus_image = hemi + '_Thalamus.mif'
       if hemi == 'Right':
-        run.command('mrthreshold ' + os.path.join(mri_dir, thal_nuclei_image) + ' -abs 8200 ' + thal_mask_path)
+        mask_command = 'mrthreshold ' + os.path.join(mri_dir, thal_nuclei_image) + ' -abs 8200 ' + thal_mask_path
       else:
-        run.command('mrcalc ' + os.path.join(mri_dir, thal_nuclei_image) + ' 0 -gt '
-                    + os.path.join(mri_dir, thal_nuclei_image) + ' 8200 -lt '
-                    + '-mult ' + thal_mask_path)
-      run.command('voxel2mesh ' + thal_mask_path + ' ' + init_mesh_path)
-      app.cleanup(thal_mask_path)
-      progress.increment()
-      run.command('meshfilter ' + init_mesh_path + ' smooth ' + smooth_mesh_path + ' -smooth_spatial 2 -smooth_influence 2')
-      app.cleanup(init_mesh_path)
-      progress.increment()
-      run.command('mesh2voxel ' + smooth_mesh_path + ' ' + template_image + ' ' + thalamus_image)
-      app.cleanup(smooth_mesh_path)
-      progress.increment()
+        mask_command = 'mrcalc ' + os.path.join(mri_dir, thal_nuclei_image) + ' 0 -gt ' \
+                       + os.path.join(mri_dir, thal_nuclei_image) + ' 8200 -lt ' \
+                       + '-mult ' + thal_mask_path
+      sequences.append(cached_mesh_sequence([ ( mask_command, [ ] ) ]
+                                            + smooth_mesh_sequence('voxel2mesh ' + thal_mask_path + ' ' + init_mesh_path,
+                                                                   init_mesh_path, smooth_mesh_path, template_image, thalamus_image,
+                                                                   smooth_options=' -smooth_spatial 2 -smooth_influence 2',
+                                                                   intermediates=[ thal_mask_path ]),
+                                            smooth_mesh_path, [ os.path.join(mri_dir, thal_nuclei_image) ]))
       tissue_images[1].append(thalamus_image)
+    progress = app.ProgressBar('Using detected FreeSurfer thalamic nuclei module output', len(sequences))
+    run_sequences(sequences, progress)
     progress.done()
 
   if have_first:
-    app.console('Running FSL FIRST to segment sub-cortical grey matter structures')
     from_first = SGM_FIRST_MAP.copy()
     if hippocampi_method == 'subfields':
       from_first = { key: value for key, value in from_first.items() if 'Hippocampus' not in value }
@@ -515,20 +642,26 @@ def execute(): #pylint: disable=unused-variable
       from_first = { key: value for key, value in from_first.items() if 'Hippocampus' not in value and 'Amygdala' not in value }
     if thalami_method != 'first':
       from_first = { key: value for key, value in from_first.items() if 'Thalamus' not in value }
-    run.command(first_cmd + ' -s ' + ','.join(from_first.keys()) + ' -i T1.nii -b -o first')
-    fsl.check_first('first', from_first.keys())
-    app.cleanup(glob.glob('T1_to_std_sub.*'))
-    progress = app.ProgressBar('Mapping FIRST segmentations to image', 2*len(from_first))
+    first_inputs = [ norm_image, os.path.join(fsl_path, 'etc', 'fslversion'), find_executable(first_cmd) ]
+    sequences = [ ]
+    first_structures = [ ]
     for key, value in from_first.items():
       vtk_in_path = 'first-' + key + '_first.vtk'
       vtk_converted_path = 'first-' + key + '_transformed.vtk'
-      run.command('meshconvert ' + vtk_in_path + ' ' + vtk_converted_path + ' -transform first2real T1.nii')
-      app.cleanup(vtk_in_path)
-      progress.increment()
-      run.command('mesh2voxel ' + vtk_converted_path + ' ' + template_image + ' ' + value + '.mif')
-      app.cleanup(vtk_converted_path)
+      sequences.append(cached_mesh_sequence([ ( 'meshconvert ' + vtk_in_path + ' ' + vtk_converted_path + ' -transform first2real T1.nii', [ vtk_in_path ] ),
+                                              ( functools.partial(mesh2voxel, vtk_converted_path, template_image, value + '.mif'), [ vtk_converted_path ] ) ],
+                                            vtk_converted_path, first_inputs))
+      if not is_cached(sequences[-1]):
+        first_structures.append(key)
       tissue_images[1].append(value + '.mif')
-      progress.increment()
+    # Only need to run FIRST for those structures for which meshes are not already cached
+    if first_structures:
+      app.console('Running FSL FIRST to segment sub-cortical grey matter structures')
+      run.command(first_cmd + ' -s ' + ','.join(first_structures) + ' -i T1.nii -b -o first')
+      fsl.check_first('first', first_structures)
+      app.cleanup(glob.glob('T1_to_std_sub.*'))
+    progress = app.ProgressBar('Mapping FIRST segmentations to image', len(sequences))
+    run_sequences(sequences, progress)
     if not have_fast:
       app.cleanup('T1.nii')
     app.cleanup(glob.glob('first*'))
@@ -608,31 +741,34 @@ def voxel2scanner(voxel, header):
   #   Generate one 'pial-like' surface containing the GM and WM of the cerebellum,
   #   and another with just the WM
   if not have_fast:
-    progress = app.ProgressBar('Adding FreeSurfer cerebellar segmentations directly', 6)
+    sequences = [ ]
     for hemi in [ 'Left-', 'Right-' ]:
       wm_index = [ index for index, tissue, name in CEREBELLUM_ASEG if name.startswith(hemi) and 'White' in name ][0]
       gm_index = [ index for index, tissue, name in CEREBELLUM_ASEG if name.startswith(hemi) and 'Cortex' in name ][0]
-      run.command('mrcalc ' + aparc_image + ' ' + str(wm_index) + ' -eq ' + aparc_image + ' ' + str(gm_index) + ' -eq -add - | ' + \
-                  'voxel2mesh - ' + hemi + 'cerebellum_all_init.vtk')
-      progress.increment()
-      run.command('mrcalc ' + aparc_image + ' ' + str(gm_index) + ' -eq - | ' + \
-                  'voxel2mesh - ' + hemi + 'cerebellum_grey_init.vtk')
-      progress.increment()
+      init_commands = { 'all': 'mrcalc ' + aparc_image + ' ' + str(wm_index) + ' -eq ' + aparc_image + ' ' + str(gm_index) + ' -eq -add - | ' + \
+                               'voxel2mesh - ' + hemi + 'cerebellum_all_init.vtk',
+                        'grey': 'mrcalc ' + aparc_image + ' ' + str(gm_index) + ' -eq - | ' + \
+                                'voxel2mesh - ' + hemi + 'cerebellum_grey_init.vtk' }
       for name, tissue in { 'all':2, 'grey':1 }.items():
-        run.command('meshfilter ' + hemi + 'cerebellum_' + name + '_init.vtk smooth ' + hemi + 'cerebellum_' + name + '.vtk')
-        app.cleanup(hemi + 'cerebellum_' + name + '_init.vtk')
-        progress.increment()
-        run.command('mesh2voxel ' + hemi + 'cerebellum_' + name + '.vtk ' + template_image + ' ' + hemi + 'cerebellum_' + name + '.mif')
-        app.cleanup(hemi + 'cerebellum_' + name + '.vtk')
-        progress.increment()
+        sequences.append(cached_mesh_sequence(smooth_mesh_sequence(init_commands[name],
+                                                                   hemi + 'cerebellum_' + name + '_init.vtk',
+                                                                   hemi + 'cerebellum_' + name + '.vtk',
+                                                                   template_image,
+                                                                   hemi + 'cerebellum_' + name + '.mif'),
+                                              hemi + 'cerebellum_' + name + '.vtk', [ aparc_source ]))
         tissue_images[tissue].append(hemi + 'cerebellum_' + name + '.mif')
+    progress = app.ProgressBar('Adding FreeSurfer cerebellar segmentations directly', len(sequences))
+    run_sequences(sequences, progress)
     progress.done()
 
 
   # Construct images with the partial volume of each tissue
   progress = app.ProgressBar('Combining segmentations of all structures corresponding to each tissue type', 5)
   for tissue in range(0,5):
-    run.command('mrmath ' + ' '.join(tissue_images[tissue]) + (' brain_stem.mif' if tissue == 2 else '') + ' sum - | mrcalc - 1.0 -min tissue' + str(tissue) + '_init.mif')
+    if app.ARGS.mesh_bbox:
+      run.function(sum_tissue_images, tissue_images[tissue] + ([ 'brain_stem.mif' ] if tissue == 2 else [ ]), template_image, 'tissue' + str(tissue) + '_init.mif')
+    else:
+      run.command('mrmath ' + ' '.join(tissue_images[tissue]) + (' brain_stem.mif' if tissue == 2 else '') + ' sum - | mrcalc - 1.0 -min tissue' + str(tissue) + '_init.mif')
     app.cleanup(tissue_images[tissue])
     progress.increment()
   progress.done()
@@ -698,24 +834,21 @@ def voxel2scanner(voxel, header):
       # If this is the case, then we haven't yet performed any cerebellar segmentation / meshing
       # What we want to do is: for each hemisphere, combine all three "cerebellar" segments from FreeSurfer,
       #   convert to a surface, map that surface to the template image
-      progress = app.ProgressBar('Preparing images of cerebellum for intensity-based segmentation', 9)
+      progress = app.ProgressBar('Preparing images of cerebellum for intensity-based segmentation', 4)
       cerebellar_hemi_pvf_images = [ ]
+      sequences = [ ]
       for hemi in [ 'Left', 'Right' ]:
         init_mesh_path = hemi + '-Cerebellum-All-Init.vtk'
         smooth_mesh_path = hemi + '-Cerebellum-All-Smooth.vtk'
         pvf_image_path = hemi + '-Cerebellum-PVF-Template.mif'
         cerebellum_aseg_hemi = [ entry for entry in CEREBELLUM_ASEG if hemi in entry[2] ]
-        run.command('mrcalc ' + aparc_image + ' ' + str(cerebellum_aseg_hemi[0][0]) + ' -eq ' + \
-                    ' -add '.join([ aparc_image + ' ' + str(index) + ' -eq' for index, tissue, name in cerebellum_aseg_hemi[1:] ]) + ' -add - | ' + \
-                    'voxel2mesh - ' + init_mesh_path)
-        progress.increment()
-        run.command('meshfilter ' + init_mesh_path + ' smooth ' + smooth_mesh_path)
-        app.cleanup(init_mesh_path)
-        progress.increment()
-        run.command('mesh2voxel ' + smooth_mesh_path + ' ' + template_image + ' ' + pvf_image_path)
-        app.cleanup(smooth_mesh_path)
+        sequences.append(cached_mesh_sequence(smooth_mesh_sequence('mrcalc ' + aparc_image + ' ' + str(cerebellum_aseg_hemi[0][0]) + ' -eq ' + \
+                                                                   ' -add '.join([ aparc_image + ' ' + str(index) + ' -eq' for index, tissue, name in cerebellum_aseg_hemi[1:] ]) + ' -add - | ' + \
+                                                                   'voxel2mesh - ' + init_mesh_path,
+                                                                   init_mesh_path, smooth_mesh_path, template_image, pvf_image_path, crop=False),
+                                              smooth_mesh_path, [ aparc_source ]))
         cerebellar_hemi_pvf_images.append(pvf_image_path)
-        progress.increment()
+      run_sequences(sequences, progress)
 
       # Combine the two hemispheres together into:
       # - An image in preparation for running FAST
@@ -0,0 +1,230 @@
+# Copyright (c) 2008-2024 the MRtrix3 contributors.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Covered Software is provided under this License on an "as is"
+# basis, without warranty of any kind, either expressed, implied, or
+# statutory, including, without limitation, warranties that the
+# Covered Software is free of defects, merchantable, fit for a
+# particular purpose or non-infringing.
+# See the Mozilla Public License v. 2.0 for more details.
+#
+# For more details, see http://www.mrtrix.org/.
+
+# Functions relating to handling of diffusion gradient encoding information
+
+# note: deal with these warnings properly when we drop support for Python 2:
+# pylint: disable=unspecified-encoding
+
+
+import math
+from mrtrix3 import CONFIG, MRtrixError
+from mrtrix3.utils import STRING_TYPES
+
+
+
+# Mirror the defaults used in src/dwi/shells.h
+BVALUE_EPSILON = 80.0
+BZERO_THRESHOLD = 10.0
+SHELLS_MIN_LINKAGE = 3
+
+
+
+# Class for deriving information from the diffusion gradient table and phase encoding
+#   table of an image, without needing to invoke mrinfo / dirstat for every query
+# The header is read only once; the gradient table is interpreted as per DWI::get_DW_scheme()
+#   (normalisation of directions, with b-value scaling), and b-value shells are
+#   clustered as per DWI::Shells; shells are therefore identical to those reported by e.g.
+#   mrinfo -shell_bvalues / -shell_indices
+# Note that the phase encoding information is provided as it is stored in the image header;
+#   exports to FSL formats (-export_grad_fsl, -export_pe_eddy) additionally depend on the
+#   image transform and strides, and should therefore still be performed using MRtrix3 commands
+# Scaling of b-values by the squared norms of the gradient directions is by default automatic,
+#   as in MRtrix3 commands; as with their -bvalue_scaling option, it can be explicitly enabled
+#   or disabled using the bvalue_scaling argument (None: automatic; True / False)
+class DWIScheme(object):
+  def __init__(self, arg, bvalue_scaling=None):
+    from mrtrix3 import image, phaseencoding #pylint: disable=import-outside-toplevel
+    if not isinstance(arg, image.Header):
+      if not isinstance(arg, STRING_TYPES):
+        raise TypeError('Error trying to derive diffusion gradient table from \'' + str(arg) + '\': Not an image header or file path')
+      arg = image.Header(arg)
+    self._header = arg
+    if 'dw_scheme' not in arg.keyval():
+      raise MRtrixError('No diffusion gradient table found in image \'' + arg.name() + '\'')
+    grad = arg.keyval()['dw_scheme']
+    if grad and not isinstance(grad[0], list):
+      grad = [ grad ]
+    try:
+      grad = [ [ float(value) for value in line ] for line in grad ]
+    except (TypeError, ValueError):
+      raise MRtrixError('Malformed diffusion gradient table in image \'' + arg.name() + '\'')
+    if not grad or any(len(line) < 4 for line in grad):
+      raise MRtrixError('Unexpected diffusion gradient table dimensions in image \'' + arg.name() + '\'')
+    num_volumes = arg.size()[3] if len(arg.size()) > 3 else 1
+    if len(grad) != num_volumes:
+      raise MRtrixError('Number of lines in gradient table (' + str(len(grad)) + ') does not match image \'' + arg.name() + '\' (' + str(num_volumes) + ' volumes)')
+    self._raw = grad
+    self._grad = self._normalise(grad, bvalue_scaling)
+    self._pe_scheme = phaseencoding.get_scheme(arg)
+    self._shells = None
+
+  @staticmethod
+  def bzero_threshold():
+    return float(CONFIG.get('BZeroThreshold', BZERO_THRESHOLD))
+
+  @staticmethod
+  def bvalue_epsilon():
+    return float(CONFIG.get('BValueEpsilon', BVALUE_EPSILON))
+
+  # Normalise gradient directions, and scale b-values by the squared norm if the
+  #   norms deviate appreciably from unity (unless explicitly enabled or disabled)
+  @staticmethod
+  def _normalise(grad, bvalue_scaling=None):
+    from mrtrix3 import app #pylint: disable=import-outside-toplevel
+    squared_norms = [ line[0]*line[0] + line[1]*line[1] + line[2]*line[2] for line in grad ]
+    max_log_scaling_factor = max(abs(math.log(value)) if value > 0.0 else 0.0 for value in squared_norms)
+    max_scaling_factor = math.exp(max_log_scaling_factor)
+    requires_bvalue_scaling = max_log_scaling_factor > 0.01
+    if bvalue_scaling is False:
+      if requires_bvalue_scaling:
+        app.console('Disabling b-value scaling during normalisation of DW vectors on user request '
+                    '(maximum scaling factor would have been ' + str(max_scaling_factor) + ')')
+      else:
+        app.warn('Disabling b-value scaling had no effect: gradient vector norms are all within tolerance '
+                 '(maximum scaling factor = ' + str(max_scaling_factor) + ')')
+      requires_bvalue_scaling = False
+    else:
+      requires_bvalue_scaling = requires_bvalue_scaling or bvalue_scaling is True
+    result = [ ]
+    for line, squared_norm in zip(grad, squared_norms):
+      norm = math.sqrt(squared_norm)
+      direction = [ value / norm for value in line[0:3] ] if squared_norm else list(line[0:3])
+      bvalue = line[3] * squared_norm if requires_bvalue_scaling else line[3]
+      result.append(direction + [ bvalue ] + list(line[4:]))
+    return result
+
+  def header(self):
+    return self._header
+  def grad(self):
+    return self._grad
+  def raw_grad(self):
+    return self._raw
+  def pe_scheme(self):
+    return self._pe_scheme
+  def num_volumes(self):
+    return len(self._grad)
+
+  # List of shells, sorted by increasing mean b-value; each is a tuple (mean b-value, volume indices)
+  def shells(self):
+    if self._shells is None:
+      self._shells = self._cluster()
+    return self._shells
+
+  def _cluster(self):
+    bvals = [ line[3] for line in self._grad ]
+    bzero_threshold = self.bzero_threshold()
+    bvalue_epsilon = self.bvalue_epsilon()
+    nonzero = [ index for index, value in enumerate(bvals) if value > bzero_threshold ]
+    def region_query(bvalue):
+      return [ index for index in nonzero if abs(bvalue - bvals[index]) < bvalue_epsilon ]
+    clusters = [ 0 ] * len(bvals)
+    visited = [ False ] * len(bvals)
+    cluster_index = 0
+    for index, value in enumerate(bvals):
+      if value <= bzero_threshold:
+        visited[index] = True
+        cluster_index = 1
+        clusters[index] = 1
+    for index, value in enumerate(bvals):
+      if visited[index]:
+        continue
+      visited[index] = True
+      neighbours = region_query(value)
+      if value > bzero_threshold and len(neighbours) < SHELLS_MIN_LINKAGE:
+        clusters[index] = 0
+        continue
+      cluster_index += 1
+      clusters[index] = cluster_index
+      # List grows during traversal, as per DBSCAN
+      position = 0
+      while position < len(neighbours):
+        neighbour = neighbours[position]
+        if not visited[neighbour]:
+          visited[neighbour] = True
+          neighbours2 = region_query(bvals[neighbour])
+          if len(neighbours2) >= SHELLS_MIN_LINKAGE:
+            neighbours.extend(neighbours2)
+        if not clusters[neighbour]:
+          clusters[neighbour] = cluster_index
+        position += 1
+    if cluster_index < 1 or cluster_index > math.sqrt(len(bvals)):
+      raise MRtrixError('DWI volumes could not be classified into b-value shells; gradient encoding may not represent a HARDI sequence')
+    shells = [ ]
+    for shell_index in range(1, cluster_index+1):
+      volumes = [ index for index, value in enumerate(clusters) if value == shell_index ]
+      shells.append((sum(bvals[index] for index in volumes) / len(volumes), volumes))
+    unassigned = [ index for index, value in enumerate(clusters) if not value ]
+    if unassigned:
+      from mrtrix3 import app #pylint: disable=import-outside-toplevel
+      app.warn('The following image volumes were not successfully assigned to a b-value shell: '
+               + ', '.join(str(index) + ' (' + str(bvals[index]) + ')' for index in unassigned))
+    return sorted(shells, key=lambda shell: shell[0])
+
+  def shell_bvalues(self):
+    return [ shell[0] for shell in self.shells() ]
+  def shell_sizes(self):
+    return [ len(shell[1]) for shell in self.shells() ]
+  def shell_indices(self):
+    return [ list(shell[1]) for shell in self.shells() ]
+
+  def has_bzero(self):
+    return self.shells()[0][0] < self.bzero_threshold()
+
+  def bzero_indices(self):
+    return list(self.shells()[0][1]) if self.has_bzero() else [ ]
+
+  # For each volume, the index of the shell to which it is attributed (-1 if unassigned)
+  def volume_shells(self):
+    result = [ -1 ] * self.num_volumes()
+    for index, shell in enumerate(self.shells()):
+      for volume in shell[1]:
+        result[volume] = index
+    return result
+
+  # Norm of the mean direction vector of each non-b=0 shell (as per dirstat -output asym)
+  def shell_asymmetries(self):
+    shells = self.shells()
+    if self.has_bzero() and len(shells) > 1:
+      shells = shells[1:]
+    result = [ ]
+    for shell in shells:
+      mean = [ sum(self._grad[volume][axis] for volume in shell[1]) / len(shell[1]) for axis in range(0, 3) ]
+      result.append(math.sqrt(sum(value*value for value in mean)))
+    return result
+
+  # Unique phase encoding configurations in order of appearance, and the (1-based) index
+  #   of the configuration for each volume, as per PhaseEncoding::scheme2eddy();
+  #   note however that these are as stored in the header, i.e. not transformed for NIfTI export
+  def pe_groups(self):
+    if not self._pe_scheme:
+      return [ ], [ ]
+    config = [ ]
+    indices = [ ]
+    for line in self._pe_scheme:
+      line = [ float(value) for value in line ]
+      for index, existing in enumerate(config):
+        if existing[0:3] == line[0:3] and (len(line) < 4 or abs(existing[3] - line[3]) < 1e-3):
+          indices.append(index+1)
+          break
+      else:
+        config.append(line)
+        indices.append(len(config))
+    return config, indices
+
+  # Write the gradient table in MRtrix format (as per mrinfo -export_grad_mrtrix)
+  def save_grad_mrtrix(self, filename, **kwargs):
+    from mrtrix3 import matrix #pylint: disable=import-outside-toplevel
+    matrix.save_matrix(filename, self._grad, **kwargs)
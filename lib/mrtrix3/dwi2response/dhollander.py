@@ -16,9 +16,9 @@
 # note: deal with these warnings properly when we drop support for Python 2:
 # pylint: disable=unspecified-encoding,consider-using-f-string
 
-import math, shutil
+import array, functools, math, shutil
 from mrtrix3 import CONFIG, MRtrixError
-from mrtrix3 import app, image, path, run
+from mrtrix3 import app, dwi, image, path, run
 
 
 WM_ALGOS = [ 'fa', 'tax', 'tournier' ]
@@ -69,6 +69,114 @@ def supports_mask(): #pylint: disable=unused-variable
 
 
 
+# The voxel selection is performed in memory on the relevant 3D images, using the
+#   functions below; these replicate the behaviour of the MRtrix3 commands previously
+#   invoked for each step, including single-precision arithmetic where it was utilised
+#   by those commands, such that the selected voxels are identical.
+
+def _isfinite(value):
+  return not (math.isnan(value) or math.isinf(value))
+
+def _count(mask):
+  return sum(1 for value in mask if value)
+
+# mrcalc <mask> <image> 0 -if
+def _masked(mask, values):
+  return [ value if inside else 0.0 for inside, value in zip(mask, values) ]
+
+# mrcalc <mask> <image> <offset> -subtract 0 -if
+def _offset(mask, values, offset):
+  offset = image.single_precision(offset)
+  return array.array('f', [ value - offset if inside else 0.0 for inside, value in zip(mask, values) ]).tolist()
+
+# Values within a mask (as per the -mask option of mrstats / mrthreshold)
+def _within(mask, values):
+  return [ value for inside, value in zip(mask, values) if inside ]
+
+# mrstats -output median
+def _median(values):
+  values = sorted(value for value in values if _isfinite(value))
+  if not values:
+    return float('nan')
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return image.single_precision(image.single_precision(values[middle] + values[middle-1]) / 2.0)
+
+# mrstats -output min
+def _minimum(values):
+  values = [ value for value in values if _isfinite(value) ]
+  return min(values) if values else float('nan')
+
+# Threshold as determined by mrthreshold in the absence of an explicit mechanism
+#   (Ridgway et al., 2009), as per Filter::estimate_optimal_threshold()
+def _optimal_threshold(values):
+  values = [ value for value in values if _isfinite(value) ]
+  if not values:
+    return float('nan')
+  count = len(values)
+  total = sum(values)
+  mean = total / count
+  stdev = math.sqrt(max((sum(value*value for value in values) - total * mean) / count, 0.0))
+  def cost(threshold):
+    threshold = image.single_precision(threshold)
+    above = [ value for value in values if value > threshold ]
+    num_above = float(len(above))
+    covariance = sum(above) / count - (num_above / count) * mean
+    denominator = stdev * math.sqrt(max((num_above - num_above * num_above / count) / count, 0.0))
+    if not denominator:
+      return float('nan') if not covariance else math.copysign(float('inf'), -covariance)
+    return image.single_precision(-covariance / denominator)
+  # Math::golden_section_search()
+  lower = min(values)
+  upper = max(values)
+  x0 = lower + 0.001*image.single_precision(upper-lower)
+  estimate = 0.5*image.single_precision(lower+upper)
+  x3 = upper - 0.001*image.single_precision(upper-lower)
+  g1 = 0.61803399
+  g2 = 1.0 - g1
+  if abs(x3 - estimate) > abs(estimate - x0):
+    x1 = estimate
+    x2 = estimate + g2 * (x3 - estimate)
+  else:
+    x2 = estimate
+    x1 = estimate - g2 * (estimate - x0)
+  f1 = cost(x1)
+  f2 = cost(x2)
+  while 0.01 * (abs(x1) + abs(x2)) < abs(x3 - x0):
+    if f2 < f1:
+      x0, x1 = x1, x2
+      x2 = g1 * x1 + g2 * x3
+      f1, f2 = f2, cost(x2)
+    else:
+      x3, x2 = x2, x1
+      x1 = g1 * x2 + g2 * x0
+      f2, f1 = f1, cost(x1)
+  return image.single_precision(x1 if f1 < f2 else x2)
+
+# Threshold as determined by mrthreshold -top / -bottom <count> -ignorezero
+def _rank_threshold(values, count, top):
+  values = sorted(value for value in values if value and not math.isnan(value))
+  index = len(values) - count if top else count - 1
+  if count < 1 or index < 0 or index >= len(values):
+    raise MRtrixError('Number of valid input image values (' + str(len(values)) + ') less than number of voxels requested via -' + ('top' if top else 'bottom') + ' option (' + str(count) + ')')
+  return values[index]
+
+# Application of a threshold by mrthreshold (comparisons with NaN always fail)
+def _greater_equal(values, threshold):
+  return [ value >= threshold for value in values ]
+def _less(values, threshold):
+  return [ value < threshold for value in values ]
+def _less_equal(values, threshold):
+  return [ value <= threshold for value in values ]
+
+# mrcalc <image> <mask> 0 -if <threshold> -gt
+def _masked_greater(mask, values, threshold):
+  threshold = image.single_precision(threshold)
+  return [ (value if inside else 0.0) > threshold for inside, value in zip(mask, values) ]
+
+
+
 def execute(): #pylint: disable=unused-variable
   bzero_threshold = float(CONFIG['BZeroThreshold']) if 'BZeroThreshold' in CONFIG else 10.0
 
@@ -77,8 +185,10 @@ def execute(): #pylint: disable=unused-variable
   app.console('-------')
 
   # Get b-values and number of volumes per b-value.
-  bvalues = [ int(round(float(x))) for x in image.mrinfo('dwi.mif', 'shell_bvalues').split() ]
-  bvolumes = [ int(x) for x in image.mrinfo('dwi.mif', 'shell_sizes').split() ]
+  dwi_scheme = dwi.DWIScheme('dwi.mif')
+  bvalues = [ int(round(x)) for x in dwi_scheme.shell_bvalues() ]
+  bvolumes = dwi_scheme.shell_sizes()
+  bindices = dwi_scheme.shell_indices()
   app.console(str(len(bvalues)) + ' unique b-value(s) detected: ' + ','.join(map(str,bvalues)) + ' with ' + ','.join(map(str,bvolumes)) + ' volumes')
   if len(bvalues) < 2:
     raise MRtrixError('Need at least 2 unique b-values (including b=0).')
@@ -111,39 +221,49 @@ def execute(): #pylint: disable=unused-variable
   else:
     app.console('Not eroding brain mask.')
     run.command('mrconvert mask.mif eroded_mask.mif -datatype bit', show=False)
-  statmaskcount = image.statistics('mask.mif', mask='mask.mif').count
-  statemaskcount = image.statistics('eroded_mask.mif', mask='eroded_mask.mif').count
+  statmaskcount = _count(image.load_voxels('mask.mif'))
+  statemaskcount = _count(image.load_voxels('eroded_mask.mif'))
   app.console('  [ mask: ' + str(statmaskcount) + ' -> ' + str(statemaskcount) + ' ]')
 
   # Get volumes, compute mean signal and SDM per b-value; compute overall SDM; get rid of erroneous values.
-  app.console('* Computing signal decay metric (SDM):')
+  # The volumes of each shell are extracted directly based on the shell indices, such that
+  #   between all shells the DWI is read only once; shells are processed concurrently.
+  app.console('* Computing signal decay metric (SDM) for b=' + ','.join(map(str,bvalues)) + '...')
   totvolumes = 0
   fullsdmcmd = 'mrcalc'
   errcmd = 'mrcalc'
   zeropath = 'mean_b' + str(bvalues[0]) + '.mif'
+  mean_jobs = [ ]
+  sdm_jobs = [ ]
   for ibv, bval in enumerate(bvalues):
-    app.console(' * b=' + str(bval) + '...')
     meanpath = 'mean_b' + str(bval) + '.mif'
-    run.command('dwiextract dwi.mif -shells ' + str(bval) + ' - | mrcalc - 0 -max - | mrmath - mean ' + meanpath + ' -axis 3', show=False)
     errpath = 'err_b' + str(bval) + '.mif'
-    run.command('mrcalc ' + meanpath + ' -finite ' + meanpath + ' 0 -if 0 -le ' + errpath + ' -datatype bit', show=False)
+    mean_jobs.append(functools.partial(run.command, 'mrconvert dwi.mif -coord 3 ' + ','.join(map(str,bindices[ibv])) + ' - | mrcalc - 0 -max - | mrmath - mean ' + meanpath + ' -axis 3', show=False))
     errcmd += ' ' + errpath
     if ibv>0:
       errcmd += ' -add'
       sdmpath = 'sdm_b' + str(bval) + '.mif'
-      run.command('mrcalc ' + zeropath + ' ' + meanpath +  ' -divide -log ' + sdmpath, show=False)
+      sdm_jobs.append(functools.partial(run.command, 'mrcalc ' + zeropath + ' ' + meanpath +  ' -divide -log ' + sdmpath, show=False))
       totvolumes += bvolumes[ibv]
       fullsdmcmd += ' ' + sdmpath + ' ' + str(bvolumes[ibv]) + ' -mult'
       if ibv>1:
         fullsdmcmd += ' -add'
+    sdm_jobs.append(functools.partial(run.command, 'mrcalc ' + meanpath + ' -finite ' + meanpath + ' 0 -if 0 -le ' + errpath + ' -datatype bit', show=False))
   fullsdmcmd += ' ' + str(totvolumes) + ' -divide full_sdm.mif'
+  run.parallel(mean_jobs)
+  run.parallel(sdm_jobs)
   run.command(fullsdmcmd, show=False)
   app.console('* Removing erroneous voxels from mask and correcting SDM...')
   run.command('mrcalc full_sdm.mif -finite full_sdm.mif 0 -if 0 -le err_sdm.mif -datatype bit', show=False)
   errcmd += ' err_sdm.mif -add 0 eroded_mask.mif -if safe_mask.mif -datatype bit'
   run.command(errcmd, show=False)
   run.command('mrcalc safe_mask.mif full_sdm.mif 0 -if 10 -min safe_sdm.mif', show=False)
-  statsmaskcount = image.statistics('safe_mask.mif', mask='safe_mask.mif').count
+  # All subsequent segmentation steps are performed in memory on these images,
+  #   with only those masks required by subsequent commands written to file
+  safe_mask = [ bool(value) for value in image.load_voxels('safe_mask.mif') ]
+  safe_sdm = image.load_voxels('safe_sdm.mif')
+  template = image.Header('safe_mask.mif')
+  statsmaskcount = _count(safe_mask)
   app.console('  [ mask: ' + str(statemaskcount) + ' -> ' + str(statsmaskcount) + ' ]')
 
 
@@ -154,19 +274,21 @@ def execute(): #pylint: disable=unused-variable
   # Compute FA and principal eigenvectors; crude WM versus GM-CSF separation based on FA.
   app.console('* Crude WM versus GM-CSF separation (at FA=' + str(app.ARGS.fa) + ')...')
   run.command('dwi2tensor dwi.mif - -mask safe_mask.mif | tensor2metric - -fa safe_fa.mif -vector safe_vecs.mif -modulate none -mask safe_mask.mif', show=False)
-  run.command('mrcalc safe_mask.mif safe_fa.mif 0 -if ' + str(app.ARGS.fa) + ' -gt crude_wm.mif -datatype bit', show=False)
-  run.command('mrcalc crude_wm.mif 0 safe_mask.mif -if _crudenonwm.mif -datatype bit', show=False)
-  statcrudewmcount = image.statistics('crude_wm.mif', mask='crude_wm.mif').count
-  statcrudenonwmcount = image.statistics('_crudenonwm.mif', mask='_crudenonwm.mif').count
+  crude_wm = _masked_greater(safe_mask, image.load_voxels('safe_fa.mif'), app.ARGS.fa)
+  crude_nonwm = [ inside and not wm for inside, wm in zip(safe_mask, crude_wm) ]
+  statcrudewmcount = _count(crude_wm)
+  statcrudenonwmcount = _count(crude_nonwm)
   app.console('  [ ' + str(statsmaskcount) + ' -> ' + str(statcrudewmcount) + ' (WM) & ' + str(statcrudenonwmcount) + ' (GM-CSF) ]')
 
   # Crude GM versus CSF separation based on SDM.
   app.console('* Crude GM versus CSF separation...')
-  crudenonwmmedian = image.statistics('safe_sdm.mif', mask='_crudenonwm.mif').median
-  run.command('mrcalc _crudenonwm.mif safe_sdm.mif ' + str(crudenonwmmedian) + ' -subtract 0 -if - | mrthreshold - - -mask _crudenonwm.mif | mrcalc _crudenonwm.mif - 0 -if crude_csf.mif -datatype bit', show=False)
-  run.command('mrcalc crude_csf.mif 0 _crudenonwm.mif -if crude_gm.mif -datatype bit', show=False)
-  statcrudegmcount = image.statistics('crude_gm.mif', mask='crude_gm.mif').count
-  statcrudecsfcount = image.statistics('crude_csf.mif', mask='crude_csf.mif').count
+  crudenonwmmedian = _median(_within(crude_nonwm, safe_sdm))
+  crudenonwm_sdm = _offset(crude_nonwm, safe_sdm, crudenonwmmedian)
+  threshold = _optimal_threshold(_within(crude_nonwm, crudenonwm_sdm))
+  crude_csf = [ inside and selected for inside, selected in zip(crude_nonwm, _greater_equal(crudenonwm_sdm, threshold)) ]
+  crude_gm = [ inside and not csf for inside, csf in zip(crude_nonwm, crude_csf) ]
+  statcrudegmcount = _count(crude_gm)
+  statcrudecsfcount = _count(crude_csf)
   app.console('  [ ' + str(statcrudenonwmcount) + ' -> ' + str(statcrudegmcount) + ' (GM) & ' + str(statcrudecsfcount) + ' (CSF) ]')
 
 
@@ -176,34 +298,40 @@ def execute(): #pylint: disable=unused-variable
 
   # Refine WM: remove high SDM outliers.
   app.console('* Refining WM...')
-  crudewmmedian = image.statistics('safe_sdm.mif', mask='crude_wm.mif').median
-  run.command('mrcalc crude_wm.mif safe_sdm.mif ' + str(crudewmmedian) + ' -subtract -abs 0 -if _crudewm_sdmad.mif', show=False)
-  crudewmmad = image.statistics('_crudewm_sdmad.mif', mask='crude_wm.mif').median
+  crudewmmedian = _median(_within(crude_wm, safe_sdm))
+  crudewmmad = _median([ abs(value) for value in _within(crude_wm, _offset(crude_wm, safe_sdm, crudewmmedian)) ])
   crudewmoutlthresh = crudewmmedian + (1.4826 * crudewmmad * 2.0)
-  run.command('mrcalc crude_wm.mif safe_sdm.mif 0 -if ' + str(crudewmoutlthresh) + ' -gt _crudewmoutliers.mif -datatype bit', show=False)
-  run.command('mrcalc _crudewmoutliers.mif 0 crude_wm.mif -if refined_wm.mif -datatype bit', show=False)
-  statrefwmcount = image.statistics('refined_wm.mif', mask='refined_wm.mif').count
+  crude_wm_outliers = _masked_greater(crude_wm, safe_sdm, crudewmoutlthresh)
+  refined_wm = [ wm and not outlier for wm, outlier in zip(crude_wm, crude_wm_outliers) ]
+  statrefwmcount = _count(refined_wm)
   app.console('  [ WM: ' + str(statcrudewmcount) + ' -> ' + str(statrefwmcount) + ' ]')
 
   # Refine GM: separate safer GM from partial volumed voxels.
   app.console('* Refining GM...')
-  crudegmmedian = image.statistics('safe_sdm.mif', mask='crude_gm.mif').median
-  run.command('mrcalc crude_gm.mif safe_sdm.mif 0 -if ' + str(crudegmmedian) + ' -gt _crudegmhigh.mif -datatype bit', show=False)
-  run.command('mrcalc _crudegmhigh.mif 0 crude_gm.mif -if _crudegmlow.mif -datatype bit', show=False)
-  run.command('mrcalc _crudegmhigh.mif safe_sdm.mif ' + str(crudegmmedian) + ' -subtract 0 -if - | mrthreshold - - -mask _crudegmhigh.mif -invert | mrcalc _crudegmhigh.mif - 0 -if _crudegmhighselect.mif -datatype bit', show=False)
-  run.command('mrcalc _crudegmlow.mif safe_sdm.mif ' + str(crudegmmedian) + ' -subtract -neg 0 -if - | mrthreshold - - -mask _crudegmlow.mif -invert | mrcalc _crudegmlow.mif - 0 -if _crudegmlowselect.mif -datatype bit', show=False)
-  run.command('mrcalc _crudegmhighselect.mif 1 _crudegmlowselect.mif -if refined_gm.mif -datatype bit', show=False)
-  statrefgmcount = image.statistics('refined_gm.mif', mask='refined_gm.mif').count
+  crudegmmedian = _median(_within(crude_gm, safe_sdm))
+  crude_gm_high = _masked_greater(crude_gm, safe_sdm, crudegmmedian)
+  crude_gm_low = [ gm and not high for gm, high in zip(crude_gm, crude_gm_high) ]
+  crude_gm_high_sdm = _offset(crude_gm_high, safe_sdm, crudegmmedian)
+  crude_gm_low_sdm = [ -value for value in _offset(crude_gm_low, safe_sdm, crudegmmedian) ]
+  crude_gm_high_select = _less(crude_gm_high_sdm, _optimal_threshold(_within(crude_gm_high, crude_gm_high_sdm)))
+  crude_gm_low_select = _less(crude_gm_low_sdm, _optimal_threshold(_within(crude_gm_low, crude_gm_low_sdm)))
+  refined_gm = [ (high and high_select) or (low and low_select)
+                 for high, high_select, low, low_select in zip(crude_gm_high, crude_gm_high_select, crude_gm_low, crude_gm_low_select) ]
+  statrefgmcount = _count(refined_gm)
   app.console('  [ GM: ' + str(statcrudegmcount) + ' -> ' + str(statrefgmcount) + ' ]')
 
   # Refine CSF: recover lost CSF from crude WM SDM outliers, separate safer CSF from partial volumed voxels.
   app.console('* Refining CSF...')
-  crudecsfmin = image.statistics('safe_sdm.mif', mask='crude_csf.mif').min
-  run.command('mrcalc _crudewmoutliers.mif safe_sdm.mif 0 -if ' + str(crudecsfmin) + ' -gt 1 crude_csf.mif -if _crudecsfextra.mif -datatype bit', show=False)
-  run.command('mrcalc _crudecsfextra.mif safe_sdm.mif ' + str(crudecsfmin) + ' -subtract 0 -if - | mrthreshold - - -mask _crudecsfextra.mif | mrcalc _crudecsfextra.mif - 0 -if refined_csf.mif -datatype bit', show=False)
-  statrefcsfcount = image.statistics('refined_csf.mif', mask='refined_csf.mif').count
+  crudecsfmin = _minimum(_within(crude_csf, safe_sdm))
+  crude_csf_extra = [ extra or csf for extra, csf in zip(_masked_greater(crude_wm_outliers, safe_sdm, crudecsfmin), crude_csf) ]
+  crude_csf_extra_sdm = _offset(crude_csf_extra, safe_sdm, crudecsfmin)
+  threshold = _optimal_threshold(_within(crude_csf_extra, crude_csf_extra_sdm))
+  refined_csf = [ inside and selected for inside, selected in zip(crude_csf_extra, _greater_equal(crude_csf_extra_sdm, threshold)) ]
+  statrefcsfcount = _count(refined_csf)
   app.console('  [ CSF: ' + str(statcrudecsfcount) + ' -> ' + str(statrefcsfcount) + ' ]')
 
+  image.save_mask('refined_wm.mif', refined_wm, template)
+
 
   # FINAL VOXEL SELECTION AND RESPONSE FUNCTION ESTIMATION
   app.console('-------')
@@ -213,8 +341,10 @@ def execute(): #pylint: disable=unused-variable
   app.console('* CSF:')
   app.console(' * Selecting final voxels (' + str(app.ARGS.csf) + '% of refined CSF)...')
   voxcsfcount = int(round(statrefcsfcount * app.ARGS.csf / 100.0))
-  run.command('mrcalc refined_csf.mif safe_sdm.mif 0 -if - | mrthreshold - - -top ' + str(voxcsfcount) + ' -ignorezero | mrcalc refined_csf.mif - 0 -if - -datatype bit | mrconvert - voxels_csf.mif -axes 0,1,2', show=False)
-  statvoxcsfcount = image.statistics('voxels_csf.mif', mask='voxels_csf.mif').count
+  refined_csf_sdm = _masked(refined_csf, safe_sdm)
+  voxels_csf = [ inside and selected for inside, selected in zip(refined_csf, _greater_equal(refined_csf_sdm, _rank_threshold(refined_csf_sdm, voxcsfcount, True))) ]
+  image.save_mask('voxels_csf.mif', voxels_csf, template)
+  statvoxcsfcount = _count(voxels_csf)
   app.console('   [ CSF: ' + str(statrefcsfcount) + ' -> ' + str(statvoxcsfcount) + ' ]')
   # Estimate CSF response function
   app.console(' * Estimating response function...')
@@ -224,9 +354,11 @@ def execute(): #pylint: disable=unused-variable
   app.console('* GM:')
   app.console(' * Selecting final voxels (' + str(app.ARGS.gm) + '% of refined GM)...')
   voxgmcount = int(round(statrefgmcount * app.ARGS.gm / 100.0))
-  refgmmedian = image.statistics('safe_sdm.mif', mask='refined_gm.mif').median
-  run.command('mrcalc refined_gm.mif safe_sdm.mif ' + str(refgmmedian) + ' -subtract -abs 1 -add 0 -if - | mrthreshold - - -bottom ' + str(voxgmcount) + ' -ignorezero | mrcalc refined_gm.mif - 0 -if - -datatype bit | mrconvert - voxels_gm.mif -axes 0,1,2', show=False)
-  statvoxgmcount = image.statistics('voxels_gm.mif', mask='voxels_gm.mif').count
+  refgmmedian = _median(_within(refined_gm, safe_sdm))
+  refined_gm_sdm = array.array('f', [ abs(value) + 1.0 if inside else 0.0 for inside, value in zip(refined_gm, _offset(refined_gm, safe_sdm, refgmmedian)) ]).tolist()
+  voxels_gm = [ inside and selected for inside, selected in zip(refined_gm, _less_equal(refined_gm_sdm, _rank_threshold(refined_gm_sdm, voxgmcount, False))) ]
+  image.save_mask('voxels_gm.mif', voxels_gm, template)
+  statvoxgmcount = _count(voxels_gm)
   app.console('   [ GM: ' + str(statrefgmcount) + ' -> ' + str(statvoxgmcount) + ' ]')
   # Estimate GM response function
   app.console(' * Estimating response function...')
@@ -251,10 +383,11 @@ def execute(): #pylint: disable=unused-variable
                 + ' -scratch ' + path.quote(app.SCRATCH_DIR)
                 + recursive_cleanup_option,
                 show=False)
+    voxels_sfwm = [ bool(value) for value in image.load_voxels('voxels_sfwm.mif') ]
   else:
     app.console('   Selecting WM single-fibre voxels using built-in (Dhollander et al., 2019) algorithm')
     run.command('mrmath dwi.mif mean mean_sig.mif -axis 3', show=False)
-    refwmcoef = image.statistics('mean_sig.mif', mask='refined_wm.mif').median * math.sqrt(4.0 * math.pi)
+    refwmcoef = _median(_within(refined_wm, image.load_voxels('mean_sig.mif'))) * math.sqrt(4.0 * math.pi)
     if sfwm_lmax:
       isiso = [ lm == 0 for lm in sfwm_lmax ]
     else:
@@ -268,13 +401,17 @@ def execute(): #pylint: disable=unused-variable
     run.command('dwi2fod msmt_csd dwi.mif ewmrf.txt abs_ewm2.mif response_csf.txt abs_csf2.mif -mask refined_wm.mif -lmax 2,0' + bvalues_option, show=False)
     run.command('mrconvert abs_ewm2.mif - -coord 3 0 | mrcalc - abs_csf2.mif -add abs_sum2.mif', show=False)
     run.command('sh2peaks abs_ewm2.mif - -num 1 -mask refined_wm.mif | peaks2amp - - | mrcalc - abs_sum2.mif -divide - | mrconvert - metric_sfwm2.mif -coord 3 0 -axes 0,1,2', show=False)
-    run.command('mrcalc refined_wm.mif metric_sfwm2.mif 0 -if - | mrthreshold - - -top ' + str(voxsfwmcount * 2) + ' -ignorezero | mrcalc refined_wm.mif - 0 -if - -datatype bit | mrconvert - refined_sfwm.mif -axes 0,1,2', show=False)
+    metric_sfwm2 = _masked(refined_wm, image.load_voxels('metric_sfwm2.mif'))
+    refined_sfwm = [ inside and selected for inside, selected in zip(refined_wm, _greater_equal(metric_sfwm2, _rank_threshold(metric_sfwm2, voxsfwmcount * 2, True))) ]
+    image.save_mask('refined_sfwm.mif', refined_sfwm, template)
     run.command('dwi2fod msmt_csd dwi.mif ewmrf.txt abs_ewm6.mif response_csf.txt abs_csf6.mif -mask refined_sfwm.mif -lmax 6,0' + bvalues_option, show=False)
     run.command('mrconvert abs_ewm6.mif - -coord 3 0 | mrcalc - abs_csf6.mif -add abs_sum6.mif', show=False)
     run.command('sh2peaks abs_ewm6.mif - -num 1 -mask refined_sfwm.mif | peaks2amp - - | mrcalc - abs_sum6.mif -divide - | mrconvert - metric_sfwm6.mif -coord 3 0 -axes 0,1,2', show=False)
-    run.command('mrcalc refined_sfwm.mif metric_sfwm6.mif 0 -if - | mrthreshold - - -top ' + str(voxsfwmcount) + ' -ignorezero | mrcalc refined_sfwm.mif - 0 -if - -datatype bit | mrconvert - voxels_sfwm.mif -axes 0,1,2', show=False)
+    metric_sfwm6 = _masked(refined_sfwm, image.load_voxels('metric_sfwm6.mif'))
+    voxels_sfwm = [ inside and selected for inside, selected in zip(refined_sfwm, _greater_equal(metric_sfwm6, _rank_threshold(metric_sfwm6, voxsfwmcount, True))) ]
+    image.save_mask('voxels_sfwm.mif', voxels_sfwm, template)
 
-  statvoxsfwmcount = image.statistics('voxels_sfwm.mif', mask='voxels_sfwm.mif').count
+  statvoxsfwmcount = _count(voxels_sfwm)
   app.console('   [ WM: ' + str(statrefwmcount) + ' -> ' + str(statvoxsfwmcount) + ' (single-fibre) ]')
   # Estimate SF WM response function
   app.console(' * Estimating response function...')
@@ -286,9 +423,9 @@ def execute(): #pylint: disable=unused-variable
   app.console('Generating outputs...')
 
   # Generate 4D binary images with voxel selections at major stages in algorithm (RGB: WM=blue, GM=green, CSF=red).
-  run.command('mrcat crude_csf.mif crude_gm.mif crude_wm.mif check_crude.mif -axis 3', show=False)
-  run.command('mrcat refined_csf.mif refined_gm.mif refined_wm.mif check_refined.mif -axis 3', show=False)
-  run.command('mrcat voxels_csf.mif voxels_gm.mif voxels_sfwm.mif check_voxels.mif -axis 3', show=False)
+  image.save_mask('check_crude.mif', [ crude_csf, crude_gm, crude_wm ], template)
+  image.save_mask('check_refined.mif', [ refined_csf, refined_gm, refined_wm ], template)
+  image.save_mask('check_voxels.mif', [ voxels_csf, voxels_gm, voxels_sfwm ], template)
 
   # Copy results to output files
   run.function(shutil.copyfile, 'response_sfwm.txt', path.from_user(app.ARGS.out_sfwm, False), show=False)
@@ -13,7 +13,7 @@
 #
 # For more details, see http://www.mrtrix.org/.
 
-import os, shutil
+import functools, os, shutil
 from mrtrix3 import MRtrixError
 from mrtrix3 import app, image, path, run
 
@@ -105,9 +105,20 @@ def execute(): #pylint: disable=unused-variable
   run.command('mrtransform 5tt.mif 5tt_regrid.mif -template fa.mif -interp linear')
 
   # Basic tissue masks
-  run.command('mrconvert 5tt_regrid.mif - -coord 3 2 -axes 0,1,2 | mrcalc - ' + str(app.ARGS.pvf) + ' -gt mask.mif -mult wm_mask.mif')
-  run.command('mrconvert 5tt_regrid.mif - -coord 3 0 -axes 0,1,2 | mrcalc - ' + str(app.ARGS.pvf) + ' -gt fa.mif ' + str(app.ARGS.fa) + ' -lt -mult mask.mif -mult gm_mask.mif')
-  run.command('mrconvert 5tt_regrid.mif - -coord 3 3 -axes 0,1,2 | mrcalc - ' + str(app.ARGS.pvf) + ' -gt fa.mif ' + str(app.ARGS.fa) + ' -lt -mult mask.mif -mult csf_mask.mif')
+  # These are derived in memory from a single read of the regridded 5TT image
+  #   (thresholds applied in single precision, as would be the case for mrcalc)
+  tissues = image.load_voxels('5tt_regrid.mif')
+  fa_image = image.load_voxels('fa.mif')
+  mask = [ bool(value) for value in image.load_voxels('mask.mif') ]
+  pvf_threshold = image.single_precision(app.ARGS.pvf)
+  fa_threshold = image.single_precision(app.ARGS.fa)
+  wm_mask = [ inside and wm > pvf_threshold for inside, wm in zip(mask, tissues[2]) ]
+  gm_mask = [ inside and gm > pvf_threshold and fa < fa_threshold for inside, gm, fa in zip(mask, tissues[0], fa_image) ]
+  csf_mask = [ inside and csf > pvf_threshold and fa < fa_threshold for inside, csf, fa in zip(mask, tissues[3], fa_image) ]
+  template = image.Header('mask.mif')
+  image.save_mask('wm_mask.mif', wm_mask, template)
+  image.save_mask('gm_mask.mif', gm_mask, template)
+  image.save_mask('csf_mask.mif', csf_mask, template)
 
   # Revise WM mask to only include single-fibre voxels
   recursive_cleanup_option=''
@@ -121,9 +132,10 @@ def execute(): #pylint: disable=unused-variable
     run.command('dwi2response fa dwi.mif wm_ss_response.txt -mask wm_mask.mif -threshold ' + str(app.ARGS.sfwm_fa_threshold) + ' -voxels wm_sf_mask.mif -scratch ' + path.quote(app.SCRATCH_DIR) + recursive_cleanup_option)
 
   # Check for empty masks
-  wm_voxels  = image.statistics('wm_sf_mask.mif', mask='wm_sf_mask.mif').count
-  gm_voxels  = image.statistics('gm_mask.mif',    mask='gm_mask.mif').count
-  csf_voxels = image.statistics('csf_mask.mif',   mask='csf_mask.mif').count
+  wm_sf_mask = [ bool(value) for value in image.load_voxels('wm_sf_mask.mif') ]
+  wm_voxels  = sum(1 for value in wm_sf_mask if value)
+  gm_voxels  = sum(1 for value in gm_mask if value)
+  csf_voxels = sum(1 for value in csf_mask if value)
   empty_masks = [ ]
   if not wm_voxels:
     empty_masks.append('WM')
@@ -146,14 +158,14 @@ def execute(): #pylint: disable=unused-variable
   sfwm_lmax_option = ''
   if wm_lmax:
     sfwm_lmax_option = ' -lmax ' + ','.join(map(str,wm_lmax))
-  run.command('amp2response dwi.mif wm_sf_mask.mif dirs.mif wm.txt' + bvalues_option + sfwm_lmax_option)
-  run.command('amp2response dwi.mif gm_mask.mif dirs.mif gm.txt' + bvalues_option + ' -isotropic')
-  run.command('amp2response dwi.mif csf_mask.mif dirs.mif csf.txt' + bvalues_option + ' -isotropic')
+  run.parallel([ functools.partial(run.command, 'amp2response dwi.mif wm_sf_mask.mif dirs.mif wm.txt' + bvalues_option + sfwm_lmax_option),
+                 functools.partial(run.command, 'amp2response dwi.mif gm_mask.mif dirs.mif gm.txt' + bvalues_option + ' -isotropic'),
+                 functools.partial(run.command, 'amp2response dwi.mif csf_mask.mif dirs.mif csf.txt' + bvalues_option + ' -isotropic') ])
   run.function(shutil.copyfile, 'wm.txt',  path.from_user(app.ARGS.out_wm,  False))
   run.function(shutil.copyfile, 'gm.txt',  path.from_user(app.ARGS.out_gm,  False))
   run.function(shutil.copyfile, 'csf.txt', path.from_user(app.ARGS.out_csf, False))
 
   # Generate output 4D binary image with voxel selections; RGB as in MSMT-CSD paper
-  run.command('mrcat csf_mask.mif gm_mask.mif wm_sf_mask.mif voxels.mif -axis 3')
+  image.save_mask('voxels.mif', [ csf_mask, gm_mask, wm_sf_mask ], template)
   if app.ARGS.voxels:
     run.command('mrconvert voxels.mif ' + path.from_user(app.ARGS.voxels), mrconvert_keyval=path.from_user(app.ARGS.input, False), force=app.FORCE_OVERWRITE)
@@ -33,6 +33,7 @@ def usage(base_parser, subparsers): #pylint: disable=unused-variable
   options.add_argument('-peak_ratio', type=float, default=0.1, help='Second-to-first-peak amplitude ratio threshold')
   options.add_argument('-max_iters', type=int, default=20, help='Maximum number of iterations')
   options.add_argument('-convergence', type=float, default=0.5, help='Percentile change in any RF coefficient required to continue iterating')
+  options.add_argument('-crop', action='store_true', help='Crop the DWI to the bounding box of the voxels to be tested prior to each CSD step; this reduces computational expense in later iterations, where only a small fraction of the brain is tested')
 
 
 
@@ -65,6 +66,8 @@ def execute(): #pylint: disable=unused-variable
 
   progress = app.ProgressBar('Optimising')
 
+  size = image.Header('mask.mif').size()[:3] if app.ARGS.crop else None
+
   iteration = 0
   while iteration < app.ARGS.max_iters:
     prefix = 'iter' + str(iteration) + '_'
@@ -94,10 +97,25 @@ def execute(): #pylint: disable=unused-variable
       rf_in_path = 'iter' + str(iteration-1) + '_RF.txt'
       mask_in_path = 'iter' + str(iteration-1) + '_SF.mif'
 
+    # Optionally restrict all image processing to the bounding box of the voxels to be tested;
+    #   since all steps are voxel-wise, this does not influence the result
+    bounds = image.mask_bounds(image.load_voxels(mask_in_path), size) if app.ARGS.crop else None
+    if bounds:
+      crop_option = ''.join(' -axis ' + str(axis) + ' ' + str(lower) + ':' + str(upper) for axis, (lower, upper) in enumerate(bounds))
+      run.command('mrgrid dwi.mif crop ' + prefix + 'dwi.mif' + crop_option)
+      run.command('mrgrid ' + mask_in_path + ' crop ' + prefix + 'mask.mif' + crop_option)
+      dwi_path = prefix + 'dwi.mif'
+      csd_mask_path = prefix + 'mask.mif'
+      sf_path = prefix + 'SF_cropped.mif'
+    else:
+      dwi_path = 'dwi.mif'
+      csd_mask_path = mask_in_path
+      sf_path = prefix + 'SF.mif'
+
     # Run CSD
-    run.command('dwi2fod csd dwi.mif ' + rf_in_path + ' ' + prefix + 'FOD.mif -mask ' + mask_in_path)
+    run.command('dwi2fod csd ' + dwi_path + ' ' + rf_in_path + ' ' + prefix + 'FOD.mif -mask ' + csd_mask_path)
     # Get amplitudes of two largest peaks, and directions of largest
-    run.command('fod2fixel ' + prefix + 'FOD.mif ' + prefix + 'fixel -peak peaks.mif -mask ' + mask_in_path + ' -fmls_no_thresholds')
+    run.command('fod2fixel ' + prefix + 'FOD.mif ' + prefix + 'fixel -peak peaks.mif -mask ' + csd_mask_path + ' -fmls_no_thresholds')
     app.cleanup(prefix + 'FOD.mif')
     run.command('fixel2voxel ' + prefix + 'fixel/peaks.mif none ' + prefix + 'amps.mif')
     run.command('mrconvert ' + prefix + 'amps.mif ' + prefix + 'first_peaks.mif -coord 3 0 -axes 0,1,2')
@@ -109,15 +127,19 @@ def execute(): #pylint: disable=unused-variable
     run.command('mrcalc ' + prefix + 'second_peaks.mif ' + prefix + 'first_peaks.mif -div ' + prefix + 'peak_ratio.mif')
     app.cleanup(prefix + 'first_peaks.mif')
     app.cleanup(prefix + 'second_peaks.mif')
-    run.command('mrcalc ' + prefix + 'peak_ratio.mif ' + str(app.ARGS.peak_ratio) + ' -lt ' + mask_in_path + ' -mult ' + prefix + 'SF.mif -datatype bit')
+    run.command('mrcalc ' + prefix + 'peak_ratio.mif ' + str(app.ARGS.peak_ratio) + ' -lt ' + csd_mask_path + ' -mult ' + sf_path + ' -datatype bit')
     app.cleanup(prefix + 'peak_ratio.mif')
     # Make sure image isn't empty
-    sf_voxel_count = image.statistics(prefix + 'SF.mif', mask=prefix+'SF.mif').count
+    sf_voxel_count = image.statistics(sf_path, mask=sf_path).count
     if not sf_voxel_count:
       raise MRtrixError('Aborting: All voxels have been excluded from single-fibre selection')
     # Generate a new response function
-    run.command('amp2response dwi.mif ' + prefix + 'SF.mif ' + prefix + 'first_dir.mif ' + prefix + 'RF.txt' + lmax_option)
+    run.command('amp2response ' + dwi_path + ' ' + sf_path + ' ' + prefix + 'first_dir.mif ' + prefix + 'RF.txt' + lmax_option)
     app.cleanup(prefix + 'first_dir.mif')
+    # Return the voxel selection to the original voxel grid
+    if bounds:
+      run.command('mrgrid ' + sf_path + ' pad ' + prefix + 'SF.mif' + ''.join(' -axis ' + str(axis) + ' ' + str(lower) + ',' + str(size[axis]-1-upper) for axis, (lower, upper) in enumerate(bounds)))
+      app.cleanup([ dwi_path, csd_mask_path, sf_path ])
 
     new_rf = matrix.load_vector(prefix + 'RF.txt')
     progress.increment('Optimising (' + str(iteration+1) + ' iterations, ' + str(sf_voxel_count) + ' voxels, RF: [ ' + ', '.join('{:.3f}'.format(n) for n in new_rf) + '] )')
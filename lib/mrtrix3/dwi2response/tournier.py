@@ -16,7 +16,7 @@
 # note: deal with these warnings properly when we drop support for Python 2:
 # pylint: disable=unspecified-encoding,consider-using-f-string
 
-import os, shutil
+import math, os, shutil
 from mrtrix3 import MRtrixError
 from mrtrix3 import app, image, matrix, path, run
 
@@ -34,6 +34,7 @@ def usage(base_parser, subparsers): #pylint: disable=unused-variable
   options.add_argument('-iter_voxels', type=int, default=0, help='Number of single-fibre voxels to select when preparing for the next iteration (default = 10 x value given in -number)')
   options.add_argument('-dilate', type=int, default=1, help='Number of mask dilation steps to apply when deriving voxel mask to test in the next iteration')
   options.add_argument('-max_iters', type=int, default=10, help='Maximum number of iterations')
+  options.add_argument('-crop', action='store_true', help='Crop the DWI to the bounding box of the voxels to be tested prior to each CSD step; this reduces computational expense in later iterations, where only a small fraction of the brain is tested')
 
 
 
@@ -57,6 +58,57 @@ def supports_mask(): #pylint: disable=unused-variable
 
 
 
+# Single-fibre voxel selection is performed in memory, replicating the behaviour of
+#   the commands otherwise used (mrcalc, mrstats, mrthreshold, maskfilter)
+
+# mrcalc <first> -sqrt 1 <second> <first> -div -sub 2 -pow -mult
+#   (in single precision, as per mrcalc)
+def _cost_function(first_peaks, second_peaks):
+  result = [ ]
+  for first, second in zip(first_peaks, second_peaks):
+    if not first > 0.0 or math.isnan(second):
+      result.append(float('nan'))
+      continue
+    root = image.single_precision(math.sqrt(first))
+    ratio = image.single_precision(1.0 - image.single_precision(second / first))
+    result.append(image.single_precision(root * image.single_precision(ratio * ratio)))
+  return result
+
+# mrthreshold <input> -top <count> <output>
+def _select_top(values, count):
+  data = sorted(value for value in values if not math.isnan(value))
+  if count < 1 or count > len(data):
+    raise MRtrixError('Number of valid input image values (' + str(len(data)) + ') less than number of voxels requested via -top option (' + str(count) + ')')
+  threshold = data[len(data) - count]
+  return [ value >= threshold for value in values ]
+
+# maskfilter <input> dilate -npass <npass> <output>
+def _dilate(mask, size, npass):
+  stride_y = size[0]
+  stride_z = size[0] * size[1]
+  for _ in range(0, npass):
+    result = list(mask)
+    for index in [ index for index, value in enumerate(mask) if value ]:
+      x = index % size[0]
+      y = (index // stride_y) % size[1]
+      z = index // stride_z
+      if x > 0:
+        result[index-1] = True
+      if y > 0:
+        result[index-stride_y] = True
+      if z > 0:
+        result[index-stride_z] = True
+      if x < size[0]-1:
+        result[index+1] = True
+      if y < size[1]-1:
+        result[index+stride_y] = True
+      if z < size[2]-1:
+        result[index+stride_z] = True
+    mask = result
+  return mask
+
+
+
 def execute(): #pylint: disable=unused-variable
   lmax_option = ''
   if app.ARGS.lmax:
@@ -73,6 +125,13 @@ def execute(): #pylint: disable=unused-variable
   elif iter_voxels < app.ARGS.number:
     raise MRtrixError ('Number of selected voxels (-iter_voxels) must be greater than number of voxels desired (-number)')
 
+  template = image.Header('mask.mif')
+  size = template.size()[:3]
+  mask = [ bool(value) for value in image.load_voxels('mask.mif') ]
+  candidates = mask
+  single_fibre = None
+  cost_images = [ ]
+
   iteration = 0
   while iteration < app.ARGS.max_iters:
     prefix = 'iter' + str(iteration) + '_'
@@ -89,30 +148,64 @@ def execute(): #pylint: disable=unused-variable
       mask_in_path = 'iter' + str(iteration-1) + '_SF_dilated.mif'
       iter_lmax_option = lmax_option
 
+    # Optionally restrict all image processing to the bounding box of the voxels to be tested;
+    #   since all steps are voxel-wise, this does not influence the result
+    bounds = image.mask_bounds(candidates, size) if app.ARGS.crop else None
+    if bounds:
+      crop_option = ''.join(' -axis ' + str(axis) + ' ' + str(lower) + ':' + str(upper) for axis, (lower, upper) in enumerate(bounds))
+      run.command('mrgrid dwi.mif crop ' + prefix + 'dwi.mif' + crop_option)
+      run.command('mrgrid ' + mask_in_path + ' crop ' + prefix + 'mask.mif' + crop_option)
+      if iteration:
+        app.cleanup(mask_in_path)
+      dwi_path = prefix + 'dwi.mif'
+      mask_in_path = prefix + 'mask.mif'
+    else:
+      dwi_path = 'dwi.mif'
+
     # Run CSD
-    run.command('dwi2fod csd dwi.mif ' + rf_in_path + ' ' + prefix + 'FOD.mif -mask ' + mask_in_path)
+    run.command('dwi2fod csd ' + dwi_path + ' ' + rf_in_path + ' ' + prefix + 'FOD.mif -mask ' + mask_in_path)
     # Get amplitudes of two largest peaks, and direction of largest
     run.command('fod2fixel ' + prefix + 'FOD.mif ' + prefix + 'fixel -peak peaks.mif -mask ' + mask_in_path + ' -fmls_no_thresholds')
     app.cleanup(prefix + 'FOD.mif')
-    if iteration:
+    if iteration or bounds:
       app.cleanup(mask_in_path)
     run.command('fixel2voxel ' + prefix + 'fixel/peaks.mif none ' + prefix + 'amps.mif -number 2')
-    run.command('mrconvert ' + prefix + 'amps.mif ' + prefix + 'first_peaks.mif -coord 3 0 -axes 0,1,2')
-    run.command('mrconvert ' + prefix + 'amps.mif ' + prefix + 'second_peaks.mif -coord 3 1 -axes 0,1,2')
-    app.cleanup(prefix + 'amps.mif')
     run.command('fixel2peaks ' + prefix + 'fixel/directions.mif ' + prefix + 'first_dir.mif -number 1')
     app.cleanup(prefix + 'fixel')
-    # Calculate the 'cost function' Donald derived for selecting single-fibre voxels
-    # https://github.com/MRtrix3/mrtrix3/pull/426
-    #  sqrt(|peak1|) * (1 - |peak2| / |peak1|)^2
-    run.command('mrcalc ' + prefix + 'first_peaks.mif -sqrt 1 ' + prefix + 'second_peaks.mif ' + prefix + 'first_peaks.mif -div -sub 2 -pow -mult '+ prefix + 'CF.mif')
-    app.cleanup(prefix + 'first_peaks.mif')
-    app.cleanup(prefix + 'second_peaks.mif')
-    voxel_count = image.statistics(prefix + 'CF.mif').count
+    # The cost function image is retained until completion, such that if resuming a previous
+    #   execution via -continue, the voxel selections of iterations that are skipped can be
+    #   reproduced after the peak amplitude images have been deleted
+    cost_images.append(prefix + 'cost.mif')
+    if run.shared.get_continue() and not os.path.isfile(prefix + 'amps.mif'):
+      cost = image.load_voxels(prefix + 'cost.mif')
+    else:
+      first_peaks, second_peaks = image.load_voxels(prefix + 'amps.mif')
+      if bounds:
+        first_peaks = image.uncrop_voxels(first_peaks, size, bounds)
+        second_peaks = image.uncrop_voxels(second_peaks, size, bounds)
+      # Calculate the 'cost function' Donald derived for selecting single-fibre voxels
+      # https://github.com/MRtrix3/mrtrix3/pull/426
+      #  sqrt(|peak1|) * (1 - |peak2| / |peak1|)^2
+      cost = _cost_function(first_peaks, second_peaks)
+      image.save_voxels(prefix + 'cost.mif', cost, template)
+    app.cleanup(prefix + 'amps.mif')
+    voxel_count = sum(1 for value in cost if not math.isnan(value) and not math.isinf(value))
     # Select the top-ranked voxels
-    run.command('mrthreshold ' + prefix + 'CF.mif -top ' + str(min([app.ARGS.number, voxel_count])) + ' ' + prefix + 'SF.mif')
+    previous_single_fibre = single_fibre
+    single_fibre = _select_top(cost, min([app.ARGS.number, voxel_count]))
+    image.save_mask(prefix + 'SF.mif', single_fibre, template)
     # Generate a new response function based on this selection
-    run.command('amp2response dwi.mif ' + prefix + 'SF.mif ' + prefix + 'first_dir.mif ' + prefix + 'RF.txt' + iter_lmax_option)
+    #   (the selected voxels necessarily lie within the bounding box)
+    if bounds:
+      # (if the response function was already generated prior to -continue, the header of
+      #   'first_dir.mif' may no longer be available, but the cropped mask is not needed)
+      if not run.shared.get_continue() or os.path.isfile(prefix + 'first_dir.mif'):
+        image.save_mask(prefix + 'SF_cropped.mif', image.crop_voxels(single_fibre, size, bounds), prefix + 'first_dir.mif')
+      run.command('amp2response ' + dwi_path + ' ' + prefix + 'SF_cropped.mif ' + prefix + 'first_dir.mif ' + prefix + 'RF.txt' + iter_lmax_option)
+      app.cleanup(prefix + 'SF_cropped.mif')
+      app.cleanup(dwi_path)
+    else:
+      run.command('amp2response dwi.mif ' + prefix + 'SF.mif ' + prefix + 'first_dir.mif ' + prefix + 'RF.txt' + iter_lmax_option)
     app.cleanup(prefix + 'first_dir.mif')
 
     new_rf = matrix.load_vector(prefix + 'RF.txt')
@@ -120,24 +213,23 @@ def execute(): #pylint: disable=unused-variable
 
     # Should we terminate?
     if iteration > 0:
-      run.command('mrcalc ' + prefix + 'SF.mif iter' + str(iteration-1) + '_SF.mif -sub ' + prefix + 'SF_diff.mif')
       app.cleanup('iter' + str(iteration-1) + '_SF.mif')
-      max_diff = image.statistics(prefix + 'SF_diff.mif').max
-      app.cleanup(prefix + 'SF_diff.mif')
-      if not max_diff:
-        app.cleanup(prefix + 'CF.mif')
+      # Converged if no voxel has been added to the selection relative to the previous iteration
+      if not any(new and not old for new, old in zip(single_fibre, previous_single_fibre)):
         run.function(shutil.copyfile, prefix + 'RF.txt', 'response.txt')
         run.function(shutil.move, prefix + 'SF.mif', 'voxels.mif')
         break
 
     # Select a greater number of top single-fibre voxels, and dilate (within bounds of initial mask);
     #   these are the voxels that will be re-tested in the next iteration
-    run.command('mrthreshold ' + prefix + 'CF.mif -top ' + str(min([iter_voxels, voxel_count])) + ' - | maskfilter - dilate - -npass ' + str(app.ARGS.dilate) + ' | mrcalc mask.mif - -mult ' + prefix + 'SF_dilated.mif')
-    app.cleanup(prefix + 'CF.mif')
+    dilated = _dilate(_select_top(cost, min([iter_voxels, voxel_count])), size, app.ARGS.dilate)
+    candidates = [ inside and value for inside, value in zip(mask, dilated) ]
+    image.save_mask(prefix + 'SF_dilated.mif', candidates, template)
 
     iteration += 1
 
   progress.done()
+  app.cleanup(cost_images)
 
   # If terminating due to running out of iterations, still need to put the results in the appropriate location
   if os.path.exists('response.txt'):
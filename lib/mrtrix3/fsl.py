@@ -13,15 +13,41 @@
 #
 # For more details, see http://www.mrtrix.org/.
 
-import os
+import json, os, shutil, time
 from distutils.spawn import find_executable
-from mrtrix3 import MRtrixError
+from mrtrix3 import CONFIG, MRtrixError
 
 
 
 
 _SUFFIX = ''
 
+# Results of FSL tool discovery are cached on the file system, so that subsequent script
+#   invocations (e.g. batch processing of many subjects) do not need to repeat them
+# The cache is invalidated if FSLDIR, PATH, or the modification time of any directory in PATH
+#   changes; individual entries are additionally invalidated if the modification time of the
+#   binary to which they refer changes
+# Location can be set using config file entry FSLCacheFile; disable using "FSLCache: false"
+_CACHE = None
+_CACHE_DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.mrtrix_fsl_cache.json')
+
+# A failed attempt to run the CUDA version of eddy is remembered for this many hours
+#   (can be changed using config file entry FSLCudaFailureExpiry)
+# To re-attempt the CUDA version before then (e.g. after installing a GPU or driver), either set
+#   "FSLCudaFailureExpiry: 0", or delete the cache file (~/.mrtrix_fsl_cache.json unless set using FSLCacheFile)
+_CUDA_FAILURE_EXPIRY = 24.0
+
+# Only failures whose output indicates the absence of a usable GPU or CUDA driver / runtime are remembered;
+#   any other failure may be specific to the data or options of that particular execution
+_CUDA_FAILURE_MESSAGES = [ 'no cuda-capable device',
+                           'all cuda-capable devices are busy or unavailable',
+                           'cuda driver version is insufficient',
+                           'no kernel image is available for execution on the device',
+                           'cudaerrornodevice',
+                           'cudaerrorinsufficientdriver',
+                           'cudaerrordevicesunavailable',
+                           'cudaerrornokernelimagefordevice' ]
+
 
 
 # Functions that may be useful for scripts that interface with FMRIB FSL tools
@@ -44,16 +70,94 @@ def check_first(prefix, structures): #pylint: disable=unused-variable
 
 
 
+def _cache_path():
+  if CONFIG.get('FSLCache', 'true').lower() in [ 'no', 'false', '0' ]:
+    return ''
+  return CONFIG.get('FSLCacheFile', _CACHE_DEFAULT_PATH)
+
+def _cache_key():
+  search_path = os.environ.get('PATH', '')
+  mtimes = [ ]
+  for directory in search_path.split(os.pathsep):
+    try:
+      mtimes.append(os.path.getmtime(directory))
+    except OSError:
+      mtimes.append(None)
+  return { 'FSLDIR': os.environ.get('FSLDIR', ''), 'PATH': search_path, 'mtimes': mtimes }
+
+def _cache_entries():
+  from mrtrix3 import app #pylint: disable=import-outside-toplevel
+  global _CACHE
+  if _CACHE is None:
+    _CACHE = { 'key': json.loads(json.dumps(_cache_key())), 'entries': { } }
+    cache_path = _cache_path()
+    if cache_path and os.path.isfile(cache_path):
+      try:
+        with open(cache_path, 'r') as cache_file:
+          data = json.load(cache_file)
+        if data.get('key') == _CACHE['key']:
+          _CACHE['entries'] = data['entries']
+          app.debug('Loaded FSL discovery cache from ' + cache_path)
+        else:
+          app.debug('FSL discovery cache at ' + cache_path + ' is out of date')
+      except (IOError, OSError, ValueError, KeyError):
+        app.debug('Unable to read FSL discovery cache from ' + cache_path)
+  return _CACHE['entries']
+
+def _binary_mtime(binary):
+  try:
+    return os.path.getmtime(binary)
+  except (OSError, TypeError):
+    return None
+
+def _cache_get(name):
+  entry = _cache_entries().get(name)
+  if entry is None:
+    return None
+  if entry['binary'] and _binary_mtime(entry['binary']) != entry['mtime']:
+    return None
+  return entry
+
+# Binary is the full path of the file on which the entry depends (if any)
+def _cache_set(name, value, binary=None, **kwargs):
+  from mrtrix3 import app #pylint: disable=import-outside-toplevel
+  entries = _cache_entries()
+  entries[name] = dict(kwargs, value=value, binary=binary, mtime=_binary_mtime(binary))
+  cache_path = _cache_path()
+  if not cache_path:
+    return
+  # Write to a temporary file first, such that concurrent script executions never encounter a partial file
+  temp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+  try:
+    with open(temp_path, 'w') as cache_file:
+      json.dump(_CACHE, cache_file)
+    shutil.move(temp_path, cache_path)
+  except (IOError, OSError):
+    app.debug('Unable to write FSL discovery cache to ' + cache_path)
+
+
+
 # Get the name of the binary file that should be invoked to run eddy;
 #   this depends on both whether or not the user has requested that the CUDA
 #   version of eddy be used, and the various names that this command could
 #   conceivably be installed as.
 def eddy_binary(cuda): #pylint: disable=unused-variable
+  from mrtrix3 import app #pylint: disable=import-outside-toplevel
+  cache_name = 'eddy_binary_' + ('cuda' if cuda else 'cpu')
+  cached = _cache_get(cache_name)
+  if cached is not None:
+    app.debug('Cached: ' + (cached['value'] if cached['value'] else 'no ' + ('CUDA' if cuda else 'CPU') + ' version of eddy'))
+    return cached['value']
+  result, binary = _find_eddy_binary(cuda)
+  _cache_set(cache_name, result, binary)
+  return result
+
+def _find_eddy_binary(cuda):
   from mrtrix3 import app #pylint: disable=import-outside-toplevel
   if cuda:
     if find_executable('eddy_cuda'):
       app.debug('Selected soft-linked CUDA version (\'eddy_cuda\')')
-      return 'eddy_cuda'
+      return 'eddy_cuda', find_executable('eddy_cuda')
     # Cuda versions are now provided with a CUDA trailing version number
     # Users may not necessarily create a softlink to one of these and
     #   call it "eddy_cuda"
@@ -64,28 +168,53 @@ def eddy_binary(cuda): #pylint: disable=unused-variable
       if os.path.isdir(directory):
         for entry in os.listdir(directory):
           if entry.startswith('eddy_cuda'):
-            binaries.append(entry)
+            binaries.append((entry, directory))
     max_version = 0.0
     exe_path = ''
-    for entry in binaries:
+    full_path = None
+    for entry, directory in binaries:
       try:
         version = float(entry.lstrip('eddy_cuda'))
         if version > max_version:
           max_version = version
           exe_path = entry
+          full_path = os.path.join(directory, entry)
       except:
         pass
     if exe_path:
       app.debug('CUDA version ' + str(max_version) + ': ' + exe_path)
-      return exe_path
+      return exe_path, full_path
     app.debug('No CUDA version of eddy found')
-    return ''
+    return '', None
   for candidate in [ 'eddy_openmp', 'eddy_cpu', 'eddy', 'fsl5.0-eddy' ]:
     if find_executable(candidate):
       app.debug(candidate)
-      return candidate
+      return candidate, find_executable(candidate)
   app.debug('No CPU version of eddy found')
-  return ''
+  return '', None
+
+
+
+# Failure of the CUDA version of eddy due to absence of a suitable GPU or driver is
+#   remembered for some time, such that it need not be re-attempted for every script execution
+def cuda_failed(binary): #pylint: disable=unused-variable
+  cached = _cache_get('cuda_failure')
+  if cached is None or cached['value'] != binary:
+    return False
+  expiry = float(CONFIG.get('FSLCudaFailureExpiry', _CUDA_FAILURE_EXPIRY))
+  return time.time() - cached['time'] < expiry * 3600.0
+
+# Returns whether or not the failure was recorded, based on the output of the failed command
+def record_cuda_failure(binary, output): #pylint: disable=unused-variable
+  from mrtrix3 import app #pylint: disable=import-outside-toplevel
+  output = output.lower()
+  # Dynamic linker unable to find the CUDA driver or runtime libraries
+  missing_library = 'error while loading shared libraries' in output and 'libcud' in output
+  if not missing_library and not any(message in output for message in _CUDA_FAILURE_MESSAGES):
+    app.debug('Failure of ' + binary + ' not attributable to GPU or CUDA driver; not recorded')
+    return False
+  _cache_set('cuda_failure', binary, find_executable(binary), time=time.time())
+  return True
 
 
 
@@ -95,13 +224,19 @@ def eddy_binary(cuda): #pylint: disable=unused-variable
 #   function will select the version 5 executable.
 def exe_name(name): #pylint: disable=unused-variable
   from mrtrix3 import app #pylint: disable=import-outside-toplevel
-  if find_executable(name):
+  cached = _cache_get('exe_name_' + name)
+  if cached is not None:
+    output = cached['value']
+  elif find_executable(name):
     output = name
   elif find_executable('fsl5.0-' + name):
     output = 'fsl5.0-' + name
-    app.warn('Using FSL binary \"' + output + '\" rather than \"' + name + '\"; suggest checking FSL installation')
   else:
     raise MRtrixError('Could not find FSL program \"' + name + '\"; please verify FSL install')
+  if cached is None:
+    _cache_set('exe_name_' + name, output, find_executable(output))
+  if output != name:
+    app.warn('Using FSL binary \"' + output + '\" rather than \"' + name + '\"; suggest checking FSL installation')
   app.debug(output)
   return output
 
@@ -22,7 +22,7 @@
 # pylint: disable=unspecified-encoding
 
 
-import json, math, os, subprocess
+import array, functools, json, math, os, subprocess, sys
 from collections import namedtuple
 from mrtrix3 import MRtrixError
 from mrtrix3.utils import STRING_TYPES
@@ -262,3 +262,426 @@ def statistics(image_path, **kwargs): #pylint: disable=unused-variable
   if app.VERBOSITY > 1:
     app.console('Result: ' + str(result))
   return result
+
+
+
+# Reduce a set of images to a single output image, in the manner of "mrmath <images> <operation> <output>",
+#   without ever providing more than 'chunk_size' images to any one invoked command.
+# This avoids exceeding limits on command-line length and on the number of simultaneously open files
+#   when dealing with very large numbers of input images, and bounds the memory usage of each process.
+# The inputs are reduced in groups of 'chunk_size' images (in parallel; see run.parallel()) into partial
+#   results, which are themselves reduced in the same way until a single image remains. For operation
+#   "mean", partial sums and partial counts of finite values are computed, such that the result retains
+#   the semantics of mrmath (non-finite values are ignored); for "weighted_mean", the semantics of
+#   multiplying each image by its weight using mrcalc are retained (non-finite values propagate).
+# Partial results of mrmath operations are stored in double precision, as is used by mrmath internally;
+#   results of "sum", "min" and "max" are therefore identical to those of a single mrmath call, and the
+#   result of "mean" differs only in the rounding of the final division to single precision.
+# If the number of inputs does not exceed 'chunk_size', a single mrmath / mrcalc call is made, which is
+#   identical to performing the reduction directly.
+REDUCTION_OPERATIONS = [ 'mean', 'weighted_mean', 'sum', 'min', 'max' ]
+REDUCTION_CHUNK_SIZE = 64
+
+def chunked_reduction(inputs, operation, output, **kwargs): #pylint: disable=unused-variable
+  from mrtrix3 import app, run #pylint: disable=import-outside-toplevel
+  chunk_size = kwargs.pop('chunk_size', REDUCTION_CHUNK_SIZE)
+  weights = kwargs.pop('weights', None)
+  keep_unary_axes = kwargs.pop('keep_unary_axes', False)
+  force = kwargs.pop('force', False)
+  if kwargs:
+    raise TypeError('Unsupported keyword arguments passed to image.chunked_reduction(): ' + str(kwargs))
+  if operation not in REDUCTION_OPERATIONS:
+    raise MRtrixError('Unsupported operation for chunked image reduction: "' + operation + '" '
+                      '(supported: ' + ', '.join(REDUCTION_OPERATIONS) + ')')
+  if chunk_size < 3:
+    raise MRtrixError('Chunk size for image reduction must be at least 3')
+  inputs = list(inputs)
+  if not inputs:
+    raise MRtrixError('No input images provided for image reduction')
+  if operation == 'weighted_mean':
+    if weights is None or len(weights) != len(inputs):
+      raise MRtrixError('Weighted mean image reduction requires one weight per input image')
+    weight_sum = sum(float(weight) for weight in weights)
+    if weight_sum <= 0:
+      raise MRtrixError('The sum of weights for image reduction must be positive')
+  elif weights is not None:
+    raise MRtrixError('Weights can only be used with the "weighted_mean" image reduction operation')
+  axes_option = [ '-keep_unary_axes' ] if keep_unary_axes else [ ]
+
+  # Intermediate images are stored alongside the output, with deterministic names
+  #   so that the -continue option remains applicable
+  output_dir, output_name = os.path.split(output)
+  intermediate_prefix = os.path.join(output_dir, '_' + output_name.split('.')[0] + '_')
+  intermediates = [ ]
+
+  # Distribute items evenly across the minimal number of chunks, such that
+  #   no chunk contains a single image (which mrmath would not accept)
+  def chunks(items):
+    count = -(-len(items) // chunk_size)
+    return [ items[(index*len(items))//count:((index+1)*len(items))//count] for index in range(count) ]
+
+  def intermediate(stage, index, label):
+    name = intermediate_prefix + label + '_' + str(stage) + '_' + str(index) + '.mif'
+    intermediates.append(name)
+    return name
+
+  # Partial results from previous stages are provided with a weight of None
+  def mrcalc_weighted_sum(images, image_weights, target):
+    cmd = [ 'mrcalc' ]
+    for position, (image_path, weight) in enumerate(zip(images, image_weights)):
+      cmd += [ image_path ] + ([ str(weight), '-mult' ] if weight is not None else [ ]) + ([ '-add' ] if position else [ ])
+    return cmd + [ target ]
+
+  # Reduce a list of images using an mrmath operation until no more than chunk_size remain
+  def mrmath_tree(images, mrmath_operation, label, stage=0):
+    while len(images) > chunk_size:
+      partials = [ intermediate(stage, index, label) for index in range(len(chunks(images))) ]
+      run.parallel([ functools.partial(run.command, [ 'mrmath', chunk, mrmath_operation ] + axes_option + [ '-datatype', 'float64', partial ], force=True)
+                     for chunk, partial in zip(chunks(images), partials) ])
+      images = partials
+      stage += 1
+    return images
+
+  if operation == 'weighted_mean':
+    nonzero = [ (image_path, weight) for image_path, weight in zip(inputs, weights) if float(weight) != 0 ]
+    images = [ item[0] for item in nonzero ]
+    image_weights = [ item[1] for item in nonzero ]
+    stage = 0
+    while len(images) > chunk_size:
+      partials = [ intermediate(stage, index, 'wsum') for index in range(len(chunks(images))) ]
+      run.parallel([ functools.partial(run.command, mrcalc_weighted_sum(chunk, chunk_weights, partial), force=True)
+                     for chunk, chunk_weights, partial in zip(chunks(images), chunks(image_weights), partials) ])
+      images = partials
+      image_weights = [ None ] * len(partials)
+      stage += 1
+    cmd = mrcalc_weighted_sum(images, image_weights, output)
+    run.command(cmd[:-1] + [ '%.16f' % weight_sum, '-div', output ], force=force)
+  elif operation == 'mean' and len(inputs) > chunk_size:
+    input_chunks = chunks(inputs)
+    sums = [ intermediate(0, index, 'sum') for index in range(len(input_chunks)) ]
+    counts = [ intermediate(0, index, 'count') for index in range(len(input_chunks)) ]
+    jobs = [ ]
+    for chunk, partial_sum, partial_count in zip(input_chunks, sums, counts):
+      jobs.append(functools.partial(run.command, [ 'mrmath', chunk, 'sum' ] + axes_option + [ '-datatype', 'float64', partial_sum ], force=True))
+      count_cmd = [ 'mrcalc' ]
+      for image_path in chunk:
+        count_cmd += [ image_path, '-finite' ] + ([ '-add' ] if len(count_cmd) > 1 else [ ])
+      jobs.append(functools.partial(run.command, count_cmd + [ '-datatype', 'uint32', partial_count ], force=True))
+    run.parallel(jobs)
+    sums = mrmath_tree(sums, 'sum', 'sum', 1)
+    counts = mrmath_tree(counts, 'sum', 'count', 1)
+    total_sum = intermediate('total', 0, 'sum')
+    total_count = intermediate('total', 0, 'count')
+    run.parallel([ functools.partial(run.command, [ 'mrmath', sums, 'sum' ] + axes_option + [ '-datatype', 'float64', total_sum ], force=True),
+                   functools.partial(run.command, [ 'mrmath', counts, 'sum' ] + axes_option + [ total_count ], force=True) ])
+    run.command([ 'mrcalc', total_sum, total_count, '-div', output ], force=force)
+  else:
+    images = inputs if operation == 'mean' else mrmath_tree(inputs, operation, operation)
+    run.command([ 'mrmath', images, operation ] + axes_option + [ output ], force=force)
+
+  if intermediates:
+    app.debug(str(len(intermediates)) + ' intermediate images generated for reduction of ' + str(len(inputs)) + ' images')
+    app.cleanup(intermediates)
+
+
+
+# Construct a 4D image (e.g. in the 5TT format) in a single mrcalc invocation, in which each volume is either:
+#   - labels_to_volumes(): the mask of those voxels in a 3D label image that contain any of a set of labels;
+#   - combine_volumes(): the sum of a set of volumes of a 4D input image (e.g. tissue probabilities).
+# 'volumes' contains, for each output volume, a list of labels / input volume indices; an empty list
+#   results in a volume containing zeroes. The output image is of type float32.
+# The labels / weights to be applied to each output volume are provided to mrcalc as 4D images on the
+#   voxel grid of the input; these are written directly based on the input image header, such that
+#   each input image volume is read only once, and no intermediate image is generated per output volume.
+# Intermediate images are stored alongside the output with deterministic names, such that the
+#   -continue option remains applicable.
+def labels_to_volumes(label_image, output, volumes, **kwargs): #pylint: disable=unused-variable
+  from mrtrix3 import app, run #pylint: disable=import-outside-toplevel
+  force = kwargs.pop('force', False)
+  if kwargs:
+    raise TypeError('Unsupported keyword arguments passed to image.labels_to_volumes(): ' + str(kwargs))
+  volumes = [ list(labels) for labels in volumes ]
+  depth = max(len(labels) for labels in volumes) if volumes else 0
+  if not depth:
+    raise MRtrixError('No labels provided for construction of image \'' + output + '\'')
+  header = Header(label_image)
+  cmd = [ 'mrcalc' ]
+  intermediates = [ ]
+  # Each level image provides, for each output volume, one of the labels to be selected;
+  #   volumes with fewer labels are padded with NaN, which never compares equal to any label
+  for index in range(0, depth):
+    level_image = _volumes_intermediate(output, 'levels', index)
+    _write_volume_values(level_image, [ labels[index] if index < len(labels) else float('nan') for labels in volumes ], header, 'f')
+    intermediates.append(level_image)
+    cmd += [ label_image, level_image, '-eq' ] + ([ '-or' ] if index else [ ])
+  run.command(cmd + [ '-datatype', 'float32', output ], force=force)
+  app.cleanup(intermediates)
+
+def combine_volumes(input_image, output, volumes, **kwargs): #pylint: disable=unused-variable
+  from mrtrix3 import app, run #pylint: disable=import-outside-toplevel
+  force = kwargs.pop('force', False)
+  if kwargs:
+    raise TypeError('Unsupported keyword arguments passed to image.combine_volumes(): ' + str(kwargs))
+  volumes = [ [ int(index) for index in indices ] for indices in volumes ]
+  depth = max(len(indices) for indices in volumes) if volumes else 0
+  if not depth:
+    raise MRtrixError('No input volumes provided for construction of image \'' + output + '\'')
+  header = Header(input_image)
+  layer_cmd = [ ]
+  cmd = [ 'mrcalc' ]
+  intermediates = [ ]
+  # Each layer selects at most one input volume for each output volume, and is multiplied by a
+  #   binary weight image if some output volumes receive no contribution from that layer;
+  #   a layer that draws from only a single input volume is extracted as that volume alone,
+  #   and is broadcast across all output volumes
+  for index in range(0, depth):
+    selection = [ indices[index] if index < len(indices) else None for indices in volumes ]
+    sources = sorted(set(volume for volume in selection if volume is not None))
+    if len(sources) == 1:
+      coord = [ sources[0] ]
+    else:
+      coord = [ volume if volume is not None else sources[0] for volume in selection ]
+    if index:
+      layer_image = _volumes_intermediate(output, 'layer', index)
+      run.command([ 'mrconvert', input_image, '-coord', '3', ','.join(str(volume) for volume in coord), layer_image ], force=True)
+      intermediates.append(layer_image)
+      cmd += [ layer_image ]
+    else:
+      layer_cmd = [ 'mrconvert', input_image, '-coord', '3', ','.join(str(volume) for volume in coord), '-', '|' ]
+      cmd += [ '-' ]
+    if None in selection or len(coord) < len(volumes):
+      weight_image = _volumes_intermediate(output, 'weights', index)
+      _write_volume_values(weight_image, [ 0 if volume is None else 1 for volume in selection ], header, 'B')
+      intermediates.append(weight_image)
+      cmd += [ weight_image, '-mult' ]
+    if index:
+      cmd += [ '-add' ]
+  run.command(layer_cmd + cmd + [ '-datatype', 'float32', output ], force=force)
+  app.cleanup(intermediates)
+
+def _volumes_intermediate(output, label, index):
+  output_dir, output_name = os.path.split(output)
+  return os.path.join(output_dir, '_' + output_name.split('.')[0] + '_' + label + '_' + str(index) + '.mif')
+
+# Write a 4D image with the voxel grid of the template header, in which each volume is filled with the
+#   corresponding entry in 'values'; 'typecode' is either 'f' (float32) or 'B' (uint8). The template
+#   image data are not read, and the output data are generated one volume at a time.
+def _write_volume_values(image_path, values, template, typecode):
+  size = template.size()[:3]
+  num_voxels = size[0]*size[1]*size[2]
+  def volume_data():
+    for value in values:
+      data = array.array(typecode, [ value ]) * num_voxels
+      if sys.byteorder == 'big':
+        data.byteswap()
+      yield data.tobytes() if hasattr(data, 'tobytes') else data.tostring()
+  _write_mif(image_path, size + [ len(values) ], template.spacing()[:3] + [ float('nan') ], template.transform(),
+             'Float32LE' if typecode == 'f' else 'UInt8', volume_data())
+
+
+# Load the intensities of a 3D image into memory, as a flat list of floating-point values
+#   (first axis varying fastest, i.e. in the order in which MRtrix3 commands loop over voxels);
+#   for a 4D image, a list containing one such list per volume is returned.
+# The image is first converted by mrconvert into a temporary single-precision file with known
+#   layout, such that native support for the various image formats is not required; values are
+#   therefore identical to those read by commands operating on single-precision data.
+# This is intended for algorithms that perform many simple operations on a small number of
+#   3D images, where repeatedly invoking commands would be far more expensive.
+# If as_array=True, the values of a 3D image are instead returned as a single-precision
+#   array.array, which is far more compact in memory than a list for large images.
+def load_voxels(image_path, **kwargs): #pylint: disable=unused-variable
+  from mrtrix3 import app, path, run #pylint: disable=import-outside-toplevel
+  as_array = kwargs.pop('as_array', False)
+  if kwargs:
+    raise TypeError('Unsupported keyword arguments passed to image.load_voxels(): ' + str(kwargs))
+  filename = path.name_temporary('mif')
+  command = [ run.exe_name(run.version_match('mrconvert')), image_path, filename, '-datatype', 'float32le', '-strides', '1,2,3' ]
+  if app.VERBOSITY > 1:
+    app.console('Loading voxel data for image file \'' + image_path + '\'')
+  app.debug(str(command))
+  try:
+    from subprocess import DEVNULL #pylint: disable=import-outside-toplevel
+  except ImportError:
+    DEVNULL = open(os.devnull, 'wb') #pylint: disable=consider-using-with
+  if subprocess.call(command, stdout=DEVNULL, stderr=DEVNULL):
+    raise MRtrixError('Could not load voxel data for image \'' + image_path + '\'')
+  try:
+    with open(filename, 'rb') as image_file:
+      header = { }
+      line = image_file.readline()
+      while line and line.strip() != b'END':
+        key, _, value = line.decode('utf-8', 'replace').partition(':')
+        header[key.strip()] = value.strip()
+        line = image_file.readline()
+      size = [ int(value) for value in header['dim'].split(',') ]
+      if len(size) not in [ 3, 4 ]:
+        raise MRtrixError('Image \'' + image_path + '\' is neither 3D nor 4D; cannot load voxel data')
+      if header['datatype'] != 'Float32LE' or header['layout'] != ','.join('+' + str(axis) for axis in range(0, len(size))) or not header['file'].startswith('. '):
+        raise MRtrixError('Unexpected format of converted image data for image \'' + image_path + '\'')
+      image_file.seek(int(header['file'].split()[1]))
+      data = array.array('f')
+      data.fromfile(image_file, size[0]*size[1]*size[2]*(size[3] if len(size) == 4 else 1))
+  except (EOFError, KeyError, ValueError):
+    raise MRtrixError('Error reading voxel data for image \'' + image_path + '\'')
+  finally:
+    os.remove(filename)
+  if sys.byteorder == 'big':
+    data.byteswap()
+  if len(size) == 3:
+    return data if as_array else data.tolist()
+  num_voxels = size[0]*size[1]*size[2]
+  return [ data[volume*num_voxels:(volume+1)*num_voxels].tolist() for volume in range(0, size[3]) ]
+
+
+
+# Round a value to single precision, as is the case for image data loaded using
+#   load_voxels() and for the results of operations performed by e.g. mrcalc
+def single_precision(value): #pylint: disable=unused-variable
+  return array.array('f', [ value ])[0]
+
+
+
+# Determine the bounding box of a 3D mask loaded using load_voxels(), as a list of [first, last]
+#   voxel indices for each spatial axis; this is expanded by 'margin' voxels, but not beyond the
+#   image FOV (as per "mrgrid crop -mask"). Returns None if the mask is empty.
+def mask_bounds(mask, size, margin=1): #pylint: disable=unused-variable
+  bounds = None
+  plane = size[0] * size[1]
+  for index, value in enumerate(mask):
+    if value:
+      position = [ index % size[0], (index // size[0]) % size[1], index // plane ]
+      if bounds is None:
+        bounds = [ [ coordinate, coordinate ] for coordinate in position ]
+      else:
+        for axis in range(0, 3):
+          bounds[axis][0] = min(bounds[axis][0], position[axis])
+          bounds[axis][1] = max(bounds[axis][1], position[axis])
+  if bounds is None:
+    return None
+  return [ [ max(0, lower - margin), min(size[axis]-1, upper + margin) ] for axis, (lower, upper) in enumerate(bounds) ]
+
+
+
+# Extract the values within a bounding box (see mask_bounds()) from a 3D image loaded using
+#   load_voxels(), yielding the values as they would be loaded from the cropped image
+def crop_voxels(values, size, bounds): #pylint: disable=unused-variable
+  result = [ ]
+  for z in range(bounds[2][0], bounds[2][1]+1):
+    for y in range(bounds[1][0], bounds[1][1]+1):
+      offset = size[0] * (y + size[1] * z)
+      result.extend(values[offset+bounds[0][0]:offset+bounds[0][1]+1])
+  return result
+
+
+
+# Inverse of crop_voxels(): reinsert the values of a cropped image into the original
+#   voxel grid, with voxels outside of the bounding box set to 'fill'
+def uncrop_voxels(values, size, bounds, fill=0.0): #pylint: disable=unused-variable
+  result = [ fill ] * (size[0] * size[1] * size[2])
+  width = bounds[0][1] - bounds[0][0] + 1
+  position = 0
+  for z in range(bounds[2][0], bounds[2][1]+1):
+    for y in range(bounds[1][0], bounds[1][1]+1):
+      offset = size[0] * (y + size[1] * z)
+      result[offset+bounds[0][0]:offset+bounds[0][1]+1] = values[position:position+width]
+      position += width
+  return result
+
+
+
+# Write one or more binary masks, as loaded / generated in memory (see load_voxels()),
+#   to a bitwise .mif image; the image geometry is taken from 'template' (Header instance
+#   or file path). If multiple masks are provided, these are concatenated along a fourth axis.
+def save_mask(image_path, masks, template): #pylint: disable=unused-variable
+  from mrtrix3 import app #pylint: disable=import-outside-toplevel
+  if not image_path.endswith('.mif'):
+    raise MRtrixError('Binary masks can only be written in .mif format (requested: \'' + image_path + '\')')
+  if not isinstance(template, Header):
+    if not isinstance(template, STRING_TYPES):
+      raise MRtrixError('Error trying to use \'' + str(template) + '\' as template: Not an image header or file path')
+    template = Header(template)
+  if not masks or not isinstance(masks[0], list):
+    masks = [ masks ]
+  size = template.size()[:3]
+  num_voxels = size[0]*size[1]*size[2]
+  if any(len(mask) != num_voxels for mask in masks):
+    raise MRtrixError('Number of mask values does not match dimensions of template image \'' + template.name() + '\'')
+  spacing = template.spacing()[:3]
+  if len(masks) > 1:
+    size = size + [ len(masks) ]
+    spacing = spacing + [ float('nan') ]
+  # Bits are packed with the most significant bit corresponding to the first voxel
+  data = bytearray((num_voxels*len(masks) + 7) // 8)
+  index = 0
+  for mask in masks:
+    for value in mask:
+      if value:
+        data[index >> 3] |= 0x80 >> (index & 7)
+      index += 1
+  app.debug('Writing ' + str(len(masks)) + ' binary mask(s) to image \'' + image_path + '\'')
+  _write_mif(image_path, size, spacing, template.transform(), 'Bit', data)
+
+
+
+# Write a 3D image, with values as loaded / generated in memory (see load_voxels()), to a
+#   single-precision floating-point .mif image; the image geometry is taken from 'template'
+#   (Header instance or file path)
+def save_voxels(image_path, values, template): #pylint: disable=unused-variable
+  from mrtrix3 import app #pylint: disable=import-outside-toplevel
+  if not image_path.endswith('.mif'):
+    raise MRtrixError('Voxel data can only be written in .mif format (requested: \'' + image_path + '\')')
+  if not isinstance(template, Header):
+    if not isinstance(template, STRING_TYPES):
+      raise MRtrixError('Error trying to use \'' + str(template) + '\' as template: Not an image header or file path')
+    template = Header(template)
+  size = template.size()[:3]
+  if len(values) != size[0]*size[1]*size[2]:
+    raise MRtrixError('Number of values does not match dimensions of template image \'' + template.name() + '\'')
+  data = array.array('f', values)
+  if sys.byteorder == 'big':
+    data.byteswap()
+  app.debug('Writing voxel data to image \'' + image_path + '\'')
+  _write_mif(image_path, size, template.spacing()[:3], template.transform(), 'Float32LE', data.tobytes() if hasattr(data, 'tobytes') else data.tostring())
+
+
+
+def _write_mif(image_path, size, spacing, transform, datatype, data):
+  from mrtrix3 import run #pylint: disable=import-outside-toplevel
+  # Files written here are not generated by run.command() / run.function();
+  #   nevertheless they may be the last file produced prior to termination
+  if run.shared.get_continue():
+    run.shared.trigger_continue([ image_path ])
+  header = 'mrtrix image\n' \
+           + 'dim: ' + ','.join(str(value) for value in size) + '\n' \
+           + 'vox: ' + ','.join(repr(float(value)) for value in spacing) + '\n' \
+           + 'layout: ' + ','.join('+' + str(axis) for axis in range(0, len(size))) + '\n' \
+           + 'datatype: ' + datatype + '\n' \
+           + ''.join('transform: ' + ','.join(repr(float(value)) for value in row[:4]) + '\n' for row in transform[:3]) \
+           + 'file: '
+  # As per MRtrix3 .mif header writing: data offset aligned to a multiple of 4 bytes
+  offset = len(header) + 18
+  offset += (4 - (offset % 4)) % 4
+  header += '. ' + str(offset) + '\nEND\n'
+  with open(image_path, 'wb') as image_file:
+    image_file.write(header.encode('utf-8'))
+    image_file.write(b'\0' * (offset - len(header)))
+    # Data may be provided as an iterable of chunks, such that large images need not be held in memory
+    if isinstance(data, (bytes, bytearray)):
+      image_file.write(data)
+    else:
+      for chunk in data:
+        image_file.write(chunk)
+
+
+
+# Determine the location of an image that has been cropped from 'template' (e.g. using
+#   "mrgrid crop"), as the voxel indices within the template image of its first voxel;
+#   both images are assumed to share the same voxel spacing and orientation
+def voxel_offset(image_in, template): #pylint: disable=unused-variable
+  if not isinstance(image_in, Header):
+    image_in = Header(image_in)
+  if not isinstance(template, Header):
+    template = Header(template)
+  transform = template.transform()
+  offset = [ image_in.transform()[axis][3] - transform[axis][3] for axis in range(0, 3) ]
+  return [ int(round(sum(transform[row][axis] * offset[row] for row in range(0, 3)) / template.spacing()[axis])) for axis in range(0, 3) ]
@@ -16,7 +16,7 @@
 # note: deal with these warnings properly when we drop support for Python 2:
 # pylint: disable=unspecified-encoding
 
-import collections, itertools, os, shlex, signal, string, subprocess, sys, tempfile, threading
+import collections, itertools, multiprocessing, os, shlex, signal, string, subprocess, sys, tempfile, threading
 from distutils.spawn import find_executable
 from mrtrix3 import ANSI, BIN_PATH, COMMAND_HISTORY_STRING, EXE_LIST, MRtrixBaseError, MRtrixError
 from mrtrix3.utils import STRING_TYPES
@@ -74,6 +74,10 @@ def __init__(self):
     self.lock = threading.Lock()
     self._num_threads = None
 
+    # Per-thread overrides of the number of threads & environment provided to invoked commands;
+    #   set by run.parallel() so that concurrently executing jobs share the available thread budget
+    self._thread_local = threading.local()
+
     # Store executing processes so that they can be killed appropriately on interrupt;
     #   e.g. by the signal handler in the mrtrix3.app module
     # Each sequential execution of run.command() either selects the first index for which the value is None,
@@ -138,7 +142,7 @@ def trigger_continue(self, entries):
     return False
 
   def get_num_threads(self):
-    return self._num_threads
+    return getattr(self._thread_local, 'num_threads', self._num_threads)
 
   def set_num_threads(self, value):
     assert value is None or (isinstance(value, int) and value >= 0)
@@ -149,6 +153,29 @@ def set_num_threads(self, value):
       self.env['ITK_GLOBAL_NUMBER_OF_THREADS'] = str(external_software_value)
       self.env['OMP_NUM_THREADS'] = str(external_software_value)
 
+  # Restrict the number of threads used by commands invoked from the calling thread only
+  def set_thread_num_threads(self, value):
+    assert isinstance(value, int) and value >= 0
+    env = self.env.copy()
+    external_software_value = 1 if value <= 1 else value
+    env['ITK_GLOBAL_NUMBER_OF_THREADS'] = str(external_software_value)
+    env['OMP_NUM_THREADS'] = str(external_software_value)
+    self._thread_local.num_threads = value
+    self._thread_local.env = env
+
+  def get_env(self):
+    return getattr(self._thread_local, 'env', self.env)
+
+  # Total number of threads that the script is permitted to make use of:
+  #   either as specified using the -nthreads option, or the number of available CPU cores
+  def get_thread_budget(self):
+    if self._num_threads is not None:
+      return max(1, self._num_threads)
+    try:
+      return multiprocessing.cpu_count()
+    except NotImplementedError:
+      return 1
+
   def get_scratch_dir(self):
     return self._scratch_dir
 
@@ -235,7 +262,7 @@ def quote_nonpipe(item):
   show = kwargs.pop('show', True)
   mrconvert_keyval = kwargs.pop('mrconvert_keyval', None)
   force = kwargs.pop('force', False)
-  env = kwargs.pop('env', shared.env)
+  env = kwargs.pop('env', shared.get_env())
   if kwargs:
     raise TypeError('Unsupported keyword arguments passed to run.command(): ' + str(kwargs))
 
@@ -524,6 +551,79 @@ def function(fn_to_execute, *args, **kwargs): #pylint: disable=unused-variable
 
 
 
+# Execute a set of mutually independent jobs concurrently.
+# Each job must be a callable that takes no arguments (typically constructed using
+#   functools.partial() around run.command() or run.function()); the return values
+#   of the jobs are provided as a list in the same order as the input jobs.
+# - 'workers' sets the maximal number of jobs to be executed at any one time;
+#     by default this is determined by the thread budget of the script (-nthreads)
+# - 'progress' can be an app.ProgressBar instance, which will be incremented once
+#     upon completion of each job
+# When more than one job runs at a time, the thread budget of the script is split between
+#   them, such that the total number of threads in use does not grow with the number of workers.
+# If the -continue option is in effect, jobs are executed sequentially, so that identification
+#   of the last file generated in the previous execution remains deterministic.
+# If any job fails, no further jobs are started, and the error from the earliest failed job
+#   is raised once all running jobs have completed.
+def parallel(jobs, **kwargs): #pylint: disable=unused-variable
+  from mrtrix3 import app #pylint: disable=import-outside-toplevel
+  workers = kwargs.pop('workers', None)
+  progress = kwargs.pop('progress', None)
+  if kwargs:
+    raise TypeError('Unsupported keyword arguments passed to run.parallel(): ' + str(kwargs))
+  jobs = list(jobs)
+  if not all(callable(job) for job in jobs):
+    raise TypeError('run.parallel() requires a list of callables as input')
+  results = [ None ] * len(jobs)
+  if not jobs:
+    return results
+  budget = shared.get_thread_budget()
+  if workers is None:
+    workers = budget
+  workers = max(1, min(int(workers), len(jobs)))
+
+  if workers == 1 or shared.get_continue():
+    for index, job in enumerate(jobs):
+      results[index] = job()
+      if progress:
+        progress.increment()
+    return results
+
+  app.debug('Executing ' + str(len(jobs)) + ' jobs using ' + str(workers) + ' concurrent workers')
+  threads_per_job = max(1, budget // workers) if shared.get_num_threads() != 0 else 0
+  pending = list(enumerate(jobs))
+  pending.reverse()
+  errors = [ ]
+  queue_lock = threading.Lock()
+
+  def worker():
+    shared.set_thread_num_threads(threads_per_job)
+    while True:
+      with queue_lock:
+        if errors or not pending:
+          return
+        index, job = pending.pop()
+      try:
+        results[index] = job()
+      except Exception as exception: # pylint: disable=broad-except
+        with queue_lock:
+          errors.append((index, exception))
+        return
+      if progress:
+        with queue_lock:
+          progress.increment()
+
+  threads = [ threading.Thread(target=worker) for _ in range(workers) ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise min(errors, key=lambda item: item[0])[1]
+  return results
+
+
+
 # When running on Windows, add the necessary '.exe' so that hopefully the correct
 #   command is found by subprocess
 def exe_name(item):
@@ -31,3 +31,41 @@ def l_for_n(coeffs): #pylint: disable=unused-variable
   if coeffs == 0:
     return 0
   return 2 * int(math.floor(math.sqrt(1.0 + 8.0 * coeffs - 3.0) / 4.0))
+
+
+
+# Calculate the mean of a set of response functions, each of which is a list of lines
+#   (one per b-value) of zonal spherical harmonic coefficients
+# Unless legacy=True, each response is first scaled by the geometric mean (across b-values)
+#   of the factors required to bring its l=0 terms to the mean l=0 terms across inputs
+def mean_response(responses, **kwargs): #pylint: disable=unused-variable
+  from mrtrix3 import MRtrixError, app #pylint: disable=import-outside-toplevel
+  legacy = kwargs.pop('legacy', False)
+  if kwargs:
+    raise TypeError('Unsupported keyword arguments passed to sh.mean_response(): ' + str(kwargs))
+  if not responses:
+    raise MRtrixError('No response functions provided for averaging')
+  num_lines = len(responses[0])
+  num_coeffs = len(responses[0][0])
+  if any(len(response) != num_lines or any(len(line) != num_coeffs for line in response) for response in responses):
+    raise MRtrixError('Response functions to be averaged must contain the same number of b-values and coefficients per b-value')
+
+  mean_lzero_terms = [ sum([ response[row][0] for response in responses ])/len(responses) for row in range(num_lines) ]
+  app.debug('Mean l=0 terms: ' + str(mean_lzero_terms))
+
+  weighted_sum_coeffs = [[0.0] * num_coeffs for _ in range(num_lines)] #pylint: disable=unused-variable
+  for response in responses:
+    if legacy:
+      multiplier = 1.0
+    else:
+      lzero_terms = [line[0] for line in response]
+      log_multiplier = 0.0
+      for lzero, mean_lzero in zip(lzero_terms, mean_lzero_terms):
+        log_multiplier += math.log(mean_lzero / lzero)
+      log_multiplier /= num_lines
+      multiplier = math.exp(log_multiplier)
+      app.debug('Subject l=0 terms: ' + str(lzero_terms))
+      app.debug('Resulting multipler: ' + str(multiplier))
+    weighted_sum_coeffs = [ [ a + multiplier*b for a, b in zip(linea, lineb) ] for linea, lineb in zip(weighted_sum_coeffs, response) ]
+
+  return [ [ f/len(responses) for f in line ] for line in weighted_sum_coeffs ]
@@ -0,0 +1,104 @@
+# Copyright (c) 2008-2024 the MRtrix3 contributors.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Covered Software is provided under this License on an "as is"
+# basis, without warranty of any kind, either expressed, implied, or
+# statutory, including, without limitation, warranties that the
+# Covered Software is free of defects, merchantable, fit for a
+# particular purpose or non-infringing.
+# See the Mozilla Public License v. 2.0 for more details.
+#
+# For more details, see http://www.mrtrix.org/.
+
+# Functions for extracting information from surface mesh files
+
+# note: deal with these warnings properly when we drop support for Python 2:
+# pylint: disable=unspecified-encoding
+
+
+import math, os, struct
+from mrtrix3 import MRtrixError
+from mrtrix3.utils import STRING_TYPES
+
+
+
+# Read the vertex positions of a surface mesh, as a list of [x, y, z] lists
+# Supported formats are those written by MRtrix3 commands that may then be fed to e.g. mesh2voxel:
+#   legacy .vtk (ASCII, or binary with big-endian float / double data) and .obj
+def load_vertices(mesh_path): #pylint: disable=unused-variable
+  extension = os.path.splitext(mesh_path)[1].lower()
+  if extension == '.obj':
+    vertices = [ ]
+    with open(mesh_path, 'r') as mesh_file:
+      for line in mesh_file:
+        line = line.split()
+        if line and line[0] == 'v':
+          vertices.append([ float(value) for value in line[1:4] ])
+    return vertices
+  if extension != '.vtk':
+    raise MRtrixError('Unsupported surface mesh file format for file \'' + mesh_path + '\'')
+  with open(mesh_path, 'rb') as mesh_file:
+    if not mesh_file.readline().startswith(b'# vtk DataFile Version'):
+      raise MRtrixError('Incorrect first line of .vtk file \'' + mesh_path + '\'')
+    mesh_file.readline()
+    is_ascii = mesh_file.readline().strip() == b'ASCII'
+    mesh_file.readline()
+    line = mesh_file.readline()
+    while line and not line.startswith(b'POINTS'):
+      line = mesh_file.readline()
+    if not line:
+      raise MRtrixError('No vertex data found in .vtk file \'' + mesh_path + '\'')
+    line = line.decode('utf-8', 'replace').split()
+    num_vertices = int(line[1])
+    if is_ascii:
+      values = [ ]
+      while len(values) < 3*num_vertices:
+        line = mesh_file.readline()
+        if not line:
+          raise MRtrixError('Premature end of vertex data in .vtk file \'' + mesh_path + '\'')
+        values.extend(float(value) for value in line.split())
+    else:
+      value_format = 'd' if line[2] == 'double' else 'f'
+      data = mesh_file.read(3 * num_vertices * struct.calcsize(value_format))
+      if len(data) != 3 * num_vertices * struct.calcsize(value_format):
+        raise MRtrixError('Premature end of vertex data in .vtk file \'' + mesh_path + '\'')
+      values = struct.unpack('>' + str(3*num_vertices) + value_format, data)
+  return [ list(values[3*index:3*index+3]) for index in range(0, num_vertices) ]
+
+
+
+# Determine the range of voxels of a template image that may be intersected by a surface mesh,
+#   as a list of [first, last] voxel indices for each spatial axis; this is expanded by 'margin'
+#   voxels, such that the voxels bordering the region are exterior to the mesh, but not beyond the
+#   image FOV. Returns None if the mesh lies entirely outside of the template image FOV.
+# The result is suitable for use with "mrgrid crop -axis"; 'template' can be either a Header
+#   instance or a file path.
+def voxel_bounds(mesh_path, template, margin=3): #pylint: disable=unused-variable
+  from mrtrix3 import image #pylint: disable=import-outside-toplevel
+  if not isinstance(template, image.Header):
+    if not isinstance(template, STRING_TYPES):
+      raise MRtrixError('Error trying to use \'' + str(template) + '\' as template: Not an image header or file path')
+    template = image.Header(template)
+  vertices = load_vertices(mesh_path)
+  if not vertices:
+    return None
+  transform = template.transform()
+  spacing = template.spacing()[:3]
+  size = template.size()[:3]
+  # Image transforms contain only rotations & translations; voxel positions can therefore be
+  #   obtained by multiplying by the transpose of the rotation component
+  lower = [ float('inf') ] * 3
+  upper = [ -float('inf') ] * 3
+  for vertex in vertices:
+    offset = [ vertex[axis] - transform[axis][3] for axis in range(0, 3) ]
+    for axis in range(0, 3):
+      position = sum(transform[row][axis] * offset[row] for row in range(0, 3)) / spacing[axis]
+      lower[axis] = min(lower[axis], position)
+      upper[axis] = max(upper[axis], position)
+  bounds = [ [ max(0, int(math.floor(lower[axis])) - margin), min(size[axis]-1, int(math.ceil(upper[axis])) + margin) ] for axis in range(0, 3) ]
+  if any(first > last for first, last in bounds):
+    return None
+  return bounds
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2008-2024 the MRtrix3 contributors.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Covered Software is provided under this License on an "as is"
+# basis, without warranty of any kind, either expressed, implied, or
+# statutory, including, without limitation, warranties that the
+# Covered Software is free of defects, merchantable, fit for a
+# particular purpose or non-infringing.
+# See the Mozilla Public License v. 2.0 for more details.
+#
+# For more details, see http://www.mrtrix.org/.
+
+# Benchmark of input discovery in population_template: synthetic input and mask directories
+#   are listed and matched across contrasts and with masks, and the pairings are verified.
+# Files are empty: image header checks spawn one process per image irrespective of how inputs
+#   are matched, and are therefore excluded from the timing.
+
+import argparse, os, shutil, sys, tempfile, time, types
+
+MRTRIX_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, os.pardir))
+sys.path.insert(0, os.path.join(MRTRIX_ROOT, 'lib'))
+
+from mrtrix3 import app, image  # pylint: disable=wrong-import-position
+
+
+
+def load_population_template():
+  script = os.path.join(MRTRIX_ROOT, 'bin', 'population_template')
+  with open(script, 'r') as script_file:
+    source = script_file.read()
+  # definitions only; do not execute the command itself
+  source = source[:source.rindex('# Execute the script')]
+  module = types.ModuleType('population_template')
+  module.__file__ = script
+  exec(compile(source, script, 'exec'), module.__dict__)  # pylint: disable=exec-used
+  return module
+
+
+
+def make_directory(directory, filenames):
+  os.makedirs(directory)
+  for filename in filenames:
+    open(os.path.join(directory, filename), 'w').close()
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Time input discovery of population_template for synthetic directories')
+  parser.add_argument('-files', type=int, default=50000, help='number of files in each input and mask directory (default: 50000)')
+  parser.add_argument('-contrasts', type=int, default=2, help='number of input directories (default: 2)')
+  parser.add_argument('-max_seconds', type=float, help='exit with an error if input discovery takes longer than this')
+  args = parser.parse_args()
+
+  population_template = load_population_template()
+  image.check_3d_nonunity = lambda image_in: None
+
+  uids = ['%06i' % index for index in range(args.files)]
+  tmpdir = tempfile.mkdtemp(prefix='tmp-population_template_inputs-')
+  try:
+    input_dirs = [os.path.join(tmpdir, 'contrast%i' % cid) for cid in range(args.contrasts)]
+    mask_dir = os.path.join(tmpdir, 'mask')
+    for cid, input_dir in enumerate(input_dirs):
+      make_directory(input_dir, ['sub-' + uid + '_contrast%i.mif' % cid for uid in uids])
+    make_directory(mask_dir, ['sub-' + uid + '_mask.mif' for uid in uids])
+    app.ARGS = argparse.Namespace(input_dir=input_dirs, mask_dir=mask_dir)
+    contrasts = argparse.Namespace(suff=['_c%i' % cid for cid in range(args.contrasts)])
+
+    start = time.time()
+    in_files = [population_template.list_directory(input_dir) for input_dir in input_dirs]
+    mask_files = population_template.list_directory(mask_dir)
+    inputs = population_template.parse_input_files(in_files, mask_files, contrasts)[0]
+    elapsed = time.time() - start
+  finally:
+    shutil.rmtree(tmpdir)
+
+  # uids are stripped of the prefix common to all subjects
+  subjects = [inp.ims_filenames[0][len('sub-'):len('sub-') + len(uids[0])] for inp in inputs]
+  if subjects != uids:
+    sys.stderr.write('inputs do not match synthetic subjects\n')
+    return 1
+  for subject, inp in zip(subjects, inputs):
+    if not subject.endswith(inp.uid) \
+        or inp.ims_filenames != ['sub-' + subject + '_contrast%i.mif' % cid for cid in range(args.contrasts)] \
+        or inp.msk_filename != 'sub-' + subject + '_mask.mif':
+      sys.stderr.write('incorrect pairing for input "' + inp.uid + '"\n')
+      return 1
+  sys.stdout.write('%i subjects, %i contrasts and masks: input discovery took %.2f s\n' % (args.files, args.contrasts, elapsed))
+  if args.max_seconds is not None and elapsed > args.max_seconds:
+    sys.stderr.write('input discovery exceeded %g s\n' % args.max_seconds)
+    return 1
+  return 0
+
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2008-2024 the MRtrix3 contributors.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Covered Software is provided under this License on an "as is"
+# basis, without warranty of any kind, either expressed, implied, or
+# statutory, including, without limitation, warranties that the
+# Covered Software is free of defects, merchantable, fit for a
+# particular purpose or non-infringing.
+# See the Mozilla Public License v. 2.0 for more details.
+#
+# For more details, see http://www.mrtrix.org/.
+
+# Test of mrtrix3.image.chunked_reduction(): the volumes of a 4D image are reduced using a small
+#   chunk size, such that multiple stages of partial results are generated, and the result of each
+#   operation is compared against that of a single mrmath / mrcalc call.
+# If a mask is provided, every second volume is NaN-masked, such that the handling of non-finite
+#   values is also tested; the first volume is assigned a weight of zero for "weighted_mean".
+
+import argparse, os, subprocess, sys
+
+MRTRIX_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, os.pardir))
+sys.path.insert(0, os.path.join(MRTRIX_ROOT, 'lib'))
+
+from mrtrix3 import image  # pylint: disable=wrong-import-position
+
+# Tolerances of testing_diff_image -frac; None requires identical values
+TOLERANCES = { 'mean': 1e-6, 'sum': 1e-6, 'min': None, 'max': None, 'weighted_mean': 1e-5 }
+
+
+
+def command(cmd):
+  subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare chunked image reductions against single mrmath / mrcalc calls')
+  parser.add_argument('input', help='4D input image, the volumes of which are reduced')
+  parser.add_argument('output_dir', help='directory in which to write the input volumes and results')
+  parser.add_argument('-mask', help='NaN-mask every second input volume outside of this mask')
+  parser.add_argument('-volumes', type=int, default=11, help='number of input volumes to reduce (default: 11)')
+  parser.add_argument('-chunk_size', type=int, default=3, help='chunk size for reduction (default: 3)')
+  args = parser.parse_args()
+
+  if not os.path.isdir(args.output_dir):
+    os.makedirs(args.output_dir)
+  inputs = [ ]
+  for index in range(args.volumes):
+    volume = os.path.join(args.output_dir, 'volume%02i.mif' % index)
+    if args.mask and index % 2:
+      unmasked = os.path.join(args.output_dir, 'volume%02i_unmasked.mif' % index)
+      command([ 'mrconvert', args.input, '-coord', '3', str(index), '-axes', '0,1,2', unmasked, '-quiet', '-force' ])
+      command([ 'mrcalc', args.mask, unmasked, 'nan', '-if', volume, '-quiet', '-force' ])
+      os.remove(unmasked)
+    else:
+      command([ 'mrconvert', args.input, '-coord', '3', str(index), '-axes', '0,1,2', volume, '-quiet', '-force' ])
+    inputs.append(volume)
+  weights = [ 0 ] + [ index + 1 for index in range(1, args.volumes) ]
+
+  success = True
+  for operation in image.REDUCTION_OPERATIONS:
+    chunked = os.path.join(args.output_dir, 'chunked_' + operation + '.mif')
+    reference = os.path.join(args.output_dir, 'reference_' + operation + '.mif')
+    if operation == 'weighted_mean':
+      image.chunked_reduction(inputs, operation, chunked, weights=weights, chunk_size=args.chunk_size, force=True)
+      cmd = [ 'mrcalc' ]
+      for position, (image_path, weight) in enumerate(zip(inputs, weights)):
+        cmd += [ image_path, str(weight), '-mult' ] + ([ '-add' ] if position else [ ])
+      command(cmd + [ str(sum(weights)), '-div', reference, '-quiet', '-force' ])
+    else:
+      image.chunked_reduction(inputs, operation, chunked, chunk_size=args.chunk_size, force=True)
+      command([ 'mrmath' ] + inputs + [ operation, reference, '-quiet', '-force' ])
+    tolerance = [ '-frac', str(TOLERANCES[operation]) ] if TOLERANCES[operation] else [ ]
+    if subprocess.call([ 'testing_diff_image', chunked, reference ] + tolerance):
+      sys.stderr.write('chunked reduction "' + operation + '" does not match single-pass result\n')
+      success = False
+  return 0 if success else 1
+
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2008-2024 the MRtrix3 contributors.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Covered Software is provided under this License on an "as is"
+# basis, without warranty of any kind, either expressed, implied, or
+# statutory, including, without limitation, warranties that the
+# Covered Software is free of defects, merchantable, fit for a
+# particular purpose or non-infringing.
+# See the Mozilla Public License v. 2.0 for more details.
+#
+# For more details, see http://www.mrtrix.org/.
+
+# Test of the mrtrix3.dwi.DWIScheme class: the normalised gradient table, b-value shells,
+#   b=0 volumes and eddy phase encoding configuration derived in Python are compared against
+#   those reported by mrinfo for the same image.
+# The eddy configuration is only compared if the image has strides 1,2,3,4, such that no
+#   transformation of the phase encoding scheme is applied by mrinfo -export_pe_eddy.
+
+import argparse, os, shutil, subprocess, sys, tempfile
+
+MRTRIX_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, os.pardir))
+sys.path.insert(0, os.path.join(MRTRIX_ROOT, 'lib'))
+
+from mrtrix3 import dwi  # pylint: disable=wrong-import-position
+
+
+
+def mrinfo(image_path, options):
+  return subprocess.check_output([ 'mrinfo', image_path ] + options).decode('utf-8')
+
+
+
+def load_text(filename):
+  with open(filename, 'r') as text_file:
+    return [ line.split() for line in text_file.read().splitlines() if line.strip() ]
+
+
+
+def close(first, second):
+  return abs(first - second) <= 1e-3 + 1e-5 * abs(second)
+
+
+
+def check(image_path, bvalue_scaling, eddy):
+  scaling_option = [ ] if bvalue_scaling is None else [ '-bvalue_scaling', 'yes' if bvalue_scaling else 'no' ]
+  description = '"' + image_path + '"' + ('' if bvalue_scaling is None else ' (b-value scaling ' + ('enabled' if bvalue_scaling else 'disabled') + ')')
+  scheme = dwi.DWIScheme(image_path, bvalue_scaling=bvalue_scaling)
+  errors = [ ]
+
+  grad = [ [ float(value) for value in line.split() ] for line in mrinfo(image_path, [ '-dwgrad' ] + scaling_option).splitlines() if line.strip() ]
+  if len(grad) != scheme.num_volumes() \
+      or any(len(ours) < 4 or not all(close(a, b) for a, b in zip(ours[0:4], theirs[0:4])) for ours, theirs in zip(scheme.grad(), grad)):
+    errors.append('normalised gradient table')
+
+  bvalues = [ float(value) for value in mrinfo(image_path, [ '-shell_bvalues' ] + scaling_option).split() ]
+  if len(bvalues) != len(scheme.shell_bvalues()) or not all(close(a, b) for a, b in zip(scheme.shell_bvalues(), bvalues)):
+    errors.append('shell b-values: ' + str(scheme.shell_bvalues()) + ' vs. ' + str(bvalues))
+
+  indices = [ [ int(value) for value in shell.split(',') if value ] for shell in mrinfo(image_path, [ '-shell_indices' ] + scaling_option).split() ]
+  if scheme.shell_indices() != indices:
+    errors.append('shell indices')
+  if scheme.shell_sizes() != [ len(shell) for shell in indices ]:
+    errors.append('shell sizes')
+
+  bzero = indices[0] if bvalues[0] < scheme.bzero_threshold() else [ ]
+  if scheme.bzero_indices() != bzero:
+    errors.append('b=0 volume indices: ' + str(scheme.bzero_indices()) + ' vs. ' + str(bzero))
+
+  if eddy:
+    tmpdir = tempfile.mkdtemp(prefix='tmp-dwischeme-')
+    try:
+      config_path = os.path.join(tmpdir, 'config.txt')
+      indices_path = os.path.join(tmpdir, 'indices.txt')
+      mrinfo(image_path, [ '-export_pe_eddy', config_path, indices_path ])
+      config = [ [ float(value) for value in line ] for line in load_text(config_path) ]
+      eddy_indices = [ int(value) for line in load_text(indices_path) for value in line ]
+    finally:
+      shutil.rmtree(tmpdir)
+    our_config, our_indices = scheme.pe_groups()
+    if len(our_config) != len(config) \
+        or any(not all(close(a, b) for a, b in zip(ours, theirs)) for ours, theirs in zip(our_config, config)):
+      errors.append('eddy configuration: ' + str(our_config) + ' vs. ' + str(config))
+    if our_indices != eddy_indices:
+      errors.append('eddy indices')
+
+  for error in errors:
+    sys.stderr.write('DWIScheme of image ' + description + ' does not match mrinfo: ' + error + '\n')
+  return not errors
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare information derived by mrtrix3.dwi.DWIScheme against that reported by mrinfo')
+  parser.add_argument('images', nargs='+', help='DWI images with diffusion gradient table in the header')
+  parser.add_argument('-eddy', action='store_true', help='also compare the eddy phase encoding configuration and indices (images must have strides 1,2,3,4)')
+  parser.add_argument('-bvalue_scaling', action='store_true', help='additionally compare results with b-value scaling explicitly enabled and disabled')
+  args = parser.parse_args()
+
+  success = True
+  for image_path in args.images:
+    for bvalue_scaling in [ None, True, False ] if args.bvalue_scaling else [ None ]:
+      success = check(image_path, bvalue_scaling, args.eddy and bvalue_scaling is None) and success
+  return 0 if success else 1
+
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2008-2024 the MRtrix3 contributors.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Covered Software is provided under this License on an "as is"
+# basis, without warranty of any kind, either expressed, implied, or
+# statutory, including, without limitation, warranties that the
+# Covered Software is free of defects, merchantable, fit for a
+# particular purpose or non-infringing.
+# See the Mozilla Public License v. 2.0 for more details.
+#
+# For more details, see http://www.mrtrix.org/.
+
+# Test of the FSL discovery cache in mrtrix3.fsl: placeholder FSL binaries are created in a
+#   temporary directory on PATH, and the cache (stored in a temporary FSLCacheFile) is verified
+#   to be re-used by a subsequent script execution, and to be invalidated if PATH, the
+#   modification time of a directory in PATH, or the modification time of a cached binary changes.
+# Failures of the CUDA version of eddy are verified to be recorded only if attributable to the
+#   absence of a GPU or CUDA driver / runtime.
+# No FSL installation is required.
+
+import os, shutil, sys, tempfile
+
+MRTRIX_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, os.pardir))
+sys.path.insert(0, os.path.join(MRTRIX_ROOT, 'lib'))
+
+from mrtrix3 import CONFIG, fsl  # pylint: disable=wrong-import-position
+
+# Output of failed eddy_cuda executions, and whether each is expected to be recorded
+CUDA_OUTPUTS = [ ('CUDA error: no CUDA-capable device is detected', True),
+                 ('terminate called after throwing an instance of \'thrust::system::system_error\'\n  what():  cudaErrorInsufficientDriver: CUDA driver version is insufficient for CUDA runtime version', True),
+                 ('eddy_cuda9.1: error while loading shared libraries: libcudart.so.9.1: cannot open shared object file: No such file or directory', True),
+                 ('eddy_cuda9.1: error while loading shared libraries: libopenblas.so.0: cannot open shared object file: No such file or directory', False),
+                 ('EDDY:::  ECScanManager::ECScanManager: Mismatch between number of volumes and acquisition parameters', False),
+                 ('Segmentation fault (core dumped)', False) ]
+
+
+
+def make_executable(directory, name):
+  filepath = os.path.join(directory, name)
+  with open(filepath, 'w') as exe_file:
+    exe_file.write('#!/bin/sh\nexit 1\n')
+  os.chmod(filepath, 0o755)
+  return filepath
+
+
+
+def new_execution():
+  # A subsequent script execution only has access to the cache file
+  fsl._CACHE = None  # pylint: disable=protected-access
+
+
+
+def touch(filepath):
+  mtime = os.path.getmtime(filepath) + 10.0
+  os.utime(filepath, (mtime, mtime))
+
+
+
+def main():
+  tmpdir = tempfile.mkdtemp(prefix='tmp-fsl_cache-')
+  original_path = os.environ.get('PATH', '')
+  errors = [ ]
+  def check(condition, description):
+    if not condition:
+      errors.append(description)
+
+  try:
+    bin_dir = os.path.join(tmpdir, 'bin')
+    other_dir = os.path.join(tmpdir, 'other')
+    os.makedirs(bin_dir)
+    os.makedirs(other_dir)
+    eddy_cpu = make_executable(bin_dir, 'eddy_openmp')
+    make_executable(bin_dir, 'eddy_cuda9.1')
+    cache_file = os.path.join(tmpdir, 'fsl_cache.json')
+    CONFIG['FSLCache'] = 'true'
+    CONFIG['FSLCacheFile'] = cache_file
+    os.environ['PATH'] = bin_dir
+    new_execution()
+
+    # Discovery results are written to the cache file, and re-used by a subsequent execution
+    check(fsl.eddy_binary(False) == 'eddy_openmp' and fsl.eddy_binary(True) == 'eddy_cuda9.1', 'eddy binaries not discovered')
+    check(os.path.isfile(cache_file), 'cache file not written')
+    new_execution()
+    cached = fsl._cache_get('eddy_binary_cpu')  # pylint: disable=protected-access
+    check(cached is not None and cached['value'] == 'eddy_openmp', 'cache entry not re-used by subsequent execution')
+
+    # Modification of a cached binary invalidates only the entry referring to it
+    touch(eddy_cpu)
+    new_execution()
+    check(fsl._cache_get('eddy_binary_cpu') is None, 'cache entry not invalidated by change of binary modification time')  # pylint: disable=protected-access
+    check(fsl._cache_get('eddy_binary_cuda') is not None, 'cache entry invalidated by modification of unrelated binary')  # pylint: disable=protected-access
+    check(fsl.eddy_binary(False) == 'eddy_openmp', 'eddy binary not re-discovered')
+    new_execution()
+    check(fsl._cache_get('eddy_binary_cpu') is not None, 're-discovered cache entry not written')  # pylint: disable=protected-access
+
+    # Modification of a directory in PATH (e.g. installation of a binary) invalidates the whole cache
+    touch(bin_dir)
+    new_execution()
+    check(fsl._cache_get('eddy_binary_cpu') is None and fsl._cache_get('eddy_binary_cuda') is None,  # pylint: disable=protected-access
+          'cache not invalidated by change of PATH directory modification time')
+    fsl.eddy_binary(False)
+
+    # As does a change of PATH itself
+    os.environ['PATH'] = os.pathsep.join([ other_dir, bin_dir ])
+    new_execution()
+    check(fsl._cache_get('eddy_binary_cpu') is None, 'cache not invalidated by change of PATH')  # pylint: disable=protected-access
+    check(fsl.eddy_binary(False) == 'eddy_openmp', 'eddy binary not discovered after change of PATH')
+    os.environ['PATH'] = bin_dir
+    new_execution()
+    check(fsl._cache_get('eddy_binary_cpu') is None, 'cache not invalidated by reverting PATH')  # pylint: disable=protected-access
+
+    # Only failures attributable to the GPU or CUDA driver / runtime are recorded
+    for output, expected in CUDA_OUTPUTS:
+      if os.path.isfile(cache_file):
+        os.remove(cache_file)
+      new_execution()
+      recorded = fsl.record_cuda_failure('eddy_cuda9.1', output)
+      new_execution()
+      check(recorded == expected and fsl.cuda_failed('eddy_cuda9.1') == expected,
+            'failure ' + ('not ' if expected else '') + 'recorded for output: "' + output + '"')
+      if expected:
+        check(not fsl.cuda_failed('eddy_cuda10.2'), 'failure recorded for other CUDA binary')
+
+    # Recorded failures expire
+    fsl.record_cuda_failure('eddy_cuda9.1', CUDA_OUTPUTS[0][0])
+    CONFIG['FSLCudaFailureExpiry'] = '0'
+    check(not fsl.cuda_failed('eddy_cuda9.1'), 'failure not expired')
+    del CONFIG['FSLCudaFailureExpiry']
+    check(fsl.cuda_failed('eddy_cuda9.1'), 'failure expired prematurely')
+
+    # With the cache disabled, nothing is written
+    if os.path.isfile(cache_file):
+      os.remove(cache_file)
+    CONFIG['FSLCache'] = 'false'
+    new_execution()
+    fsl.eddy_binary(False)
+    check(not os.path.exists(cache_file), 'cache file written despite FSLCache: false')
+  finally:
+    os.environ['PATH'] = original_path
+    shutil.rmtree(tmpdir)
+
+  for error in errors:
+    sys.stderr.write('FSL discovery cache: ' + error + '\n')
+  return 1 if errors else 0
+
+
+
+if __name__ == '__main__':
+  sys.exit(main())
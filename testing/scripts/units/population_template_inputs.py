@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2008-2024 the MRtrix3 contributors.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Covered Software is provided under this License on an "as is"
+# basis, without warranty of any kind, either expressed, implied, or
+# statutory, including, without limitation, warranties that the
+# Covered Software is free of defects, merchantable, fit for a
+# particular purpose or non-infringing.
+# See the Mozilla Public License v. 2.0 for more details.
+#
+# For more details, see http://www.mrtrix.org/.
+
+# Test of input discovery in population_template: synthetic input and mask directories, with
+#   differing filename prefixes, postfixes and ordering across contrasts and masks, are matched
+#   by unique identifier, and the resulting pairings are verified.
+# Subjects missing from a contrast or from the mask directory must result in an error.
+# Files are empty; image header checks are therefore disabled.
+
+import argparse, os, shutil, sys, tempfile, types
+
+MRTRIX_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, os.pardir))
+sys.path.insert(0, os.path.join(MRTRIX_ROOT, 'lib'))
+
+from mrtrix3 import MRtrixError, app, image  # pylint: disable=wrong-import-position
+
+
+
+def load_population_template():
+  script = os.path.join(MRTRIX_ROOT, 'bin', 'population_template')
+  with open(script, 'r') as script_file:
+    source = script_file.read()
+  # definitions only; do not execute the command itself
+  source = source[:source.rindex('# Execute the script')]
+  module = types.ModuleType('population_template')
+  module.__file__ = script
+  exec(compile(source, script, 'exec'), module.__dict__)  # pylint: disable=exec-used
+  return module
+
+
+
+def make_directory(directory, filenames):
+  os.makedirs(directory)
+  for filename in filenames:
+    open(os.path.join(directory, filename), 'w').close()
+
+
+
+# Filenames of each subject per contrast and for masks; numbering without zero-padding, such that
+#   the sorted order of filenames differs from the order of subjects
+IMAGE_FILENAMES = [ lambda subject: 'sub-' + subject + '_fa.mif',
+                    lambda subject: 'md_' + subject + '.nii.gz' ]
+MASK_FILENAME = lambda subject: 'mask-' + subject + '_brain.mif'
+
+
+
+def discover(population_template, tmpdir, contrast_subjects, mask_subjects):
+  input_dirs = [ os.path.join(tmpdir, 'contrast%i' % cid) for cid in range(len(IMAGE_FILENAMES)) ]
+  mask_dir = os.path.join(tmpdir, 'mask')
+  for input_dir, filename, subjects in zip(input_dirs, IMAGE_FILENAMES, contrast_subjects):
+    make_directory(input_dir, [ filename(subject) for subject in subjects ])
+  make_directory(mask_dir, [ MASK_FILENAME(subject) for subject in mask_subjects ])
+  app.ARGS = argparse.Namespace(input_dir=input_dirs, mask_dir=mask_dir)
+  contrasts = argparse.Namespace(suff=[ '_c%i' % cid for cid in range(len(input_dirs)) ])
+  try:
+    in_files = [ population_template.list_directory(input_dir) for input_dir in input_dirs ]
+    mask_files = population_template.list_directory(mask_dir)
+    return population_template.parse_input_files(in_files, mask_files, contrasts)[0]
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Verify matching of inputs across contrasts and with masks in population_template')
+  parser.add_argument('-files', type=int, default=300, help='number of subjects (default: 300)')
+  args = parser.parse_args()
+
+  population_template = load_population_template()
+  image.check_3d_nonunity = lambda image_in: None
+  subjects = [ str(index) for index in range(args.files) ]
+  errors = [ ]
+
+  # additional masks without corresponding images are permitted
+  inputs = discover(population_template, tempfile.mkdtemp(prefix='tmp-population_template_inputs-'),
+                    [ subjects, subjects[::-1] ], subjects + [ str(args.files + index) for index in range(10) ])
+  if sorted(inp.uid for inp in inputs) != sorted(subjects):
+    errors.append('unique identifiers do not match synthetic subjects')
+  for inp in inputs:
+    if inp.ims_filenames != [ filename(inp.uid) for filename in IMAGE_FILENAMES ] \
+        or inp.msk_filename != MASK_FILENAME(inp.uid):
+      errors.append('incorrect pairing for input "' + inp.uid + '": ' + str(inp.ims_filenames) + ', ' + str(inp.msk_filename))
+
+  for description, contrast_subjects, mask_subjects in [ ('image missing from second contrast', [ subjects, subjects[1:] ], subjects),
+                                                         ('mask missing', [ subjects, subjects ], subjects[:-1]) ]:
+    try:
+      discover(population_template, tempfile.mkdtemp(prefix='tmp-population_template_inputs-'), contrast_subjects, mask_subjects)
+      errors.append(description + ': no error raised')
+    except MRtrixError:
+      pass
+
+  for error in errors:
+    sys.stderr.write(error + '\n')
+  return 1 if errors else 0
+
+
+
+if __name__ == '__main__':
+  sys.exit(main())
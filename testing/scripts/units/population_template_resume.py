@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2008-2024 the MRtrix3 contributors.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Covered Software is provided under this License on an "as is"
+# basis, without warranty of any kind, either expressed, implied, or
+# statutory, including, without limitation, warranties that the
+# Covered Software is free of defects, merchantable, fit for a
+# particular purpose or non-infringing.
+# See the Mozilla Public License v. 2.0 for more details.
+#
+# For more details, see http://www.mrtrix.org/.
+
+# Test of resuming population_template from its checkpoints: the command is terminated once a
+#   given registration level has been recorded as complete in the scratch directory, and is then
+#   re-executed with the -continue option on that scratch directory. The resulting template is
+#   compared against that of an uninterrupted execution with the same arguments.
+# The level following the checkpoint is interrupted while in progress, such that resuming must
+#   skip all preceding commands and regenerate any images that this level had already overwritten.
+
+import argparse, glob, json, os, shutil, signal, subprocess, sys, time
+
+
+
+def completed_levels(scratch_parent):
+  for checkpoint in glob.glob(os.path.join(scratch_parent, 'population_template-tmp-*', 'checkpoint.json')):
+    try:
+      with open(checkpoint, 'r') as checkpoint_file:
+        return json.load(checkpoint_file)['completed']
+    except (IOError, ValueError):
+      pass
+  return [ ]
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Interrupt population_template after a given level, resume it, and compare the result against a reference template')
+  parser.add_argument('-after', default='nl00', help='registration level after which the first execution is terminated (default: nl00)')
+  parser.add_argument('-abs', type=float, default=0.01, help='absolute tolerance of the comparison against the reference template (default: 0.01)')
+  parser.add_argument('reference', help='template generated by an uninterrupted execution')
+  parser.add_argument('scratch', help='directory in which to create the scratch directory; must not exist')
+  parser.add_argument('arguments', nargs=argparse.REMAINDER, help='population_template arguments, starting with the input directory and output template')
+  args = parser.parse_args()
+
+  if len(args.arguments) < 2:
+    parser.error('population_template input directory and output template are required')
+  if os.path.exists(args.scratch):
+    shutil.rmtree(args.scratch)
+  os.makedirs(args.scratch)
+
+  process = subprocess.Popen([ 'population_template' ] + args.arguments + [ '-scratch', args.scratch, '-nocleanup', '-force' ])
+  while args.after not in completed_levels(args.scratch):
+    if process.poll() is not None:
+      sys.stderr.write('population_template exited before completing level "' + args.after + '"\n')
+      return 1
+    time.sleep(0.1)
+  process.send_signal(signal.SIGTERM)
+  process.wait()
+  if process.returncode == 0:
+    sys.stderr.write('population_template completed before being interrupted\n')
+    return 1
+  if completed_levels(args.scratch)[-1] != args.after:
+    sys.stderr.write('population_template was not interrupted within the level following "' + args.after + '"\n')
+    return 1
+
+  scratch_dir = glob.glob(os.path.join(args.scratch, 'population_template-tmp-*'))[0]
+  subprocess.check_call([ 'population_template' ] + args.arguments + [ '-continue', scratch_dir, 'checkpoint.json', '-force' ])
+  return subprocess.call([ 'testing_diff_image', args.arguments[1], args.reference, '-abs', str(args.abs) ])
+
+
+
+if __name__ == '__main__':
+  sys.exit(main())